@@ -9,6 +9,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'helloworld.settings')
 application = get_wsgi_application()
 
 def handler(event, context):
+    if 'profile' in event:
+        # invoked directly by ServerlessApp.profile_lambda, API Gateway events have no such key
+        import profiler
+        return profiler.remote(event)
     event['path'] = event['path'].replace("api/", "")
     # User = apps.get_model('auth', 'User')
     # return {"statusCode": 200, "body": json.dumps(dict(users=User.objects.count()))}
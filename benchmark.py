@@ -0,0 +1,128 @@
+import argparse
+import random
+import time
+import timeit
+from decimal import Decimal
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+from memory import Memory
+from orm import Index, Model, connection, decoder
+
+
+class Item(Model):
+    pass
+
+
+class Bench(Model):
+    table_name = 'benchmark'
+    indexes = (Index('grupo', range='grupo'),)
+
+
+def wide(size=200):
+    item = {'pk': 'a' * 32, 'model': 'Item'}
+    for i in range(size):
+        item['attr{}'.format(i)] = Decimal(i) / 4 if i % 2 else 'value {}'.format(i)
+    return item
+
+
+def nested(depth=8, width=4):
+    item = {'name': 'leaf', 'value': 1, 'flags': [True, False, None]}
+    for i in range(depth):
+        item = {'level{}'.format(j): item if j == 0 else {'n': j, 's': str(j)} for j in range(width)}
+        item['list'] = [i, str(i), {'n': i}]
+    return dict(item, pk='a' * 32, model='Item')
+
+
+def serialize(item):
+    serializer = TypeSerializer()
+    return {k: serializer.serialize(v) for k, v in item.items()}
+
+
+def resource_path(items):
+    # what the boto3 resource layer does to every item before QuerySet builds the Model
+    deserializer = TypeDeserializer()
+    return [Item(**{k: deserializer.deserialize(v) for k, v in item.items()}) for item in items]
+
+
+def raw_path(numbers):
+    decode = decoder(numbers)
+
+    def path(items):
+        return [Item(**decode(item)) for item in items]
+    return path
+
+
+def deserialization(rows=1000, repeat=5):
+    for name, item in (('wide', wide()), ('nested', nested())):
+        items = [serialize(item)] * rows
+        paths = [('resource', resource_path)] + [('raw {}'.format(n), raw_path(n)) for n in ('decimal', 'auto')]
+        baseline = None
+        for label, path in paths:
+            seconds = min(timeit.repeat(lambda: path(items), number=1, repeat=repeat))
+            baseline = baseline or seconds
+            print('{:<8} {:<12} {:>10.0f} items/s {:>6.2f}x'.format(name, label, rows / seconds, baseline / seconds))
+
+
+def populate(size, latency=0, throttle=0):
+    # the table is filled without latency or throttling, which only apply to the measured operations
+    backend = Memory(seed=0)
+    backend.create_table(Bench.table_name, Bench)
+    connection.use(backend)
+    objs = Bench.objects.bulk_create(
+        dict(nome='Pessoa {}'.format(i), idade=i % 100, grupo=i % 100, contato={'email': '{}@mail.com'.format(i)})
+        for i in range(size)
+    )
+    backend.latency = latency
+    backend.throttle = throttle
+    return [obj['pk'] for obj in objs]
+
+
+def operations(pks):
+    pick = random.Random(0).choice
+    groups = iter(range(100))
+    return [
+        ('create', 200, lambda: Bench.objects.create(nome='Pessoa', idade=1, grupo=100)),
+        ('get', 1000, lambda: Bench.objects.get(pick(pks))),
+        ('filter', 5, lambda: list(Bench.objects.filter(idade__lt=10))),
+        ('filter index', 20, lambda: list(Bench.objects.filter(grupo=7))),
+        ('values_list', 5, lambda: list(Bench.objects.values_list('nome', flat=True))),
+        ('count', 5, lambda: Bench.objects.count()),
+        ('delete', 5, lambda: Bench.objects.filter(grupo=next(groups)).delete()),
+    ]
+
+
+def percentile(latencies, n):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * n / 100))]
+
+
+def measure(func, repeat):
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return repeat / sum(latencies), percentile(latencies, 50), percentile(latencies, 99)
+
+
+def suite(sizes=(1000, 10000, 100000), latency=0, throttle=0):
+    print('{:>8} {:<12} {:>12} {:>10} {:>10}'.format('items', 'operation', 'ops/s', 'p50 ms', 'p99 ms'))
+    for size in sizes:
+        pks = populate(size, latency, throttle)
+        for name, repeat, func in operations(pks):
+            ops, p50, p99 = measure(func, repeat)
+            print('{:>8} {:<12} {:>12.1f} {:>10.2f} {:>10.2f}'.format(size, name, ops, p50 * 1000, p99 * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ORM benchmarks against the in-memory backend')
+    parser.add_argument('benchmark', nargs='?', default='suite', choices=('suite', 'deserialization'))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every call')
+    parser.add_argument('--throttle', type=float, default=0, help='probability of throttling a call or batch item')
+    args = parser.parse_args()
+    if args.benchmark == 'suite':
+        suite(args.sizes, args.latency, args.throttle)
+    else:
+        deserialization()
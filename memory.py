@@ -0,0 +1,634 @@
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import Attr, AttributeBase, ConditionBase
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+
+PAGE_SIZE = 1024 * 1024
+MISSING = object()
+TOKEN = re.compile(r'\s*(<>|<=|>=|[=<>(),]|[^\s=<>(),]+)')
+FUNCTIONS = {
+    'begins_with': 'begins_with', 'contains': 'contains', 'attribute_exists': 'exists',
+    'attribute_not_exists': 'not_exists', 'attribute_type': 'attribute_type',
+}
+OPERATORS = {'=': 'eq', '<>': 'ne', '<': 'lt', '<=': 'lte', '>': 'gt', '>=': 'gte'}
+
+COMPARISONS = {
+    '=': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'BETWEEN': lambda a, b, c: b <= a <= c,
+    'IN': lambda a, b: a in b,
+    'begins_with': lambda a, b: a.startswith(b),
+    'contains': lambda a, b: b in a,
+}
+
+
+def error(code, message):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, code)
+
+
+def normalize(value):
+    # what the boto3 serializer accepts and what it gives back: numbers as Decimal, no floats
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, (int, Decimal)):
+        return Decimal(value)
+    if isinstance(value, dict):
+        return {k: normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return {normalize(v) for v in value}
+    return value
+
+
+def clone(value):
+    if isinstance(value, dict):
+        return {k: clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [clone(v) for v in value]
+    if isinstance(value, set):
+        return set(value)
+    return value
+
+
+def resolve(item, tokens):
+    value = item
+    for token in tokens:
+        if not isinstance(value, dict) or token not in value:
+            return MISSING
+        value = value[token]
+    return value
+
+
+def evaluate(condition, item):
+    expression = condition.get_expression()
+    operator = expression['operator']
+    values = expression['values']
+    if operator == 'AND':
+        return evaluate(values[0], item) and evaluate(values[1], item)
+    if operator == 'OR':
+        return evaluate(values[0], item) or evaluate(values[1], item)
+    if operator == 'NOT':
+        return not evaluate(values[0], item)
+    values = [resolve(item, v.name.split('.')) if isinstance(v, AttributeBase) else normalize(v) for v in values]
+    if operator == 'attribute_exists':
+        return values[0] is not MISSING
+    if operator == 'attribute_not_exists':
+        return values[0] is MISSING
+    if MISSING in values:
+        return False
+    try:
+        return COMPARISONS[operator](*values)
+    except TypeError:
+        return False
+
+
+def project(item, expression, names=None):
+    if not expression:
+        return item
+    names = names or {}
+    projected = {}
+    for path in expression.split(','):
+        tokens = [names.get(token, token) for token in path.strip().split('.')]
+        value = resolve(item, tokens)
+        if value is not MISSING:
+            target = projected
+            for token in tokens[:-1]:
+                target = target.setdefault(token, {})
+            target[tokens[-1]] = value
+    return projected
+
+
+def size(item):
+    return len(json.dumps(item, default=str))
+
+
+def attributes(condition):
+    # top level attribute names used by a condition
+    names = set()
+    for value in condition.get_expression()['values']:
+        if isinstance(value, ConditionBase):
+            names |= attributes(value)
+        elif isinstance(value, AttributeBase):
+            names.add(value.name.split('.')[0])
+    return names
+
+
+class Parser(object):
+    # condition expression strings, as ConditionExpressionBuilder writes them, back into condition objects
+    def __init__(self, expression, names, values):
+        self.tokens = TOKEN.findall(expression)
+        self.position = 0
+        self.names = names
+        self.values = values
+
+    def parse(self):
+        condition = self.disjunction()
+        if self.position != len(self.tokens):
+            raise error('ValidationException', 'Invalid expression near {}'.format(self.peek()))
+        return condition
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected and token.upper() != expected):
+            raise error('ValidationException', 'Expected {} in expression, got {}'.format(expected, token))
+        self.position += 1
+        return token
+
+    def disjunction(self):
+        condition = self.conjunction()
+        while (self.peek() or '').upper() == 'OR':
+            self.take()
+            condition = condition | self.conjunction()
+        return condition
+
+    def conjunction(self):
+        condition = self.negation()
+        while (self.peek() or '').upper() == 'AND':
+            self.take()
+            condition = condition & self.negation()
+        return condition
+
+    def negation(self):
+        if (self.peek() or '').upper() == 'NOT':
+            self.take()
+            return ~ self.negation()
+        if self.peek() == '(':
+            self.take()
+            condition = self.disjunction()
+            self.take(')')
+            return condition
+        if self.peek() in FUNCTIONS:
+            function = FUNCTIONS[self.take()]
+            self.take('(')
+            attr = self.operand()
+            args = []
+            while self.peek() == ',':
+                self.take()
+                args.append(self.operand())
+            self.take(')')
+            return getattr(attr, function)(*args)
+        attr = self.operand()
+        operator = self.take().upper()
+        if operator == 'BETWEEN':
+            low = self.operand()
+            self.take('AND')
+            return attr.between(low, self.operand())
+        if operator == 'IN':
+            self.take('(')
+            options = [self.operand()]
+            while self.peek() == ',':
+                self.take()
+                options.append(self.operand())
+            self.take(')')
+            return attr.is_in(options)
+        if operator not in OPERATORS:
+            raise error('ValidationException', 'Invalid operator {}'.format(operator))
+        return getattr(attr, OPERATORS[operator])(self.operand())
+
+    def operand(self):
+        token = self.take()
+        if token.startswith(':'):
+            return self.values[token]
+        return Attr('.'.join(self.names.get(name, name) for name in token.split('.')))
+
+
+class LowLevelClient(object):
+    # the scans and queries of QuerySet.raw(): typed attribute values in and out, conditions as strings
+    def __init__(self, backend):
+        self.backend = backend
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+
+    def scan(self, TableName, **kwargs):
+        return self.call(self.backend.Table(TableName).scan, kwargs)
+
+    def query(self, TableName, **kwargs):
+        return self.call(self.backend.Table(TableName).query, kwargs)
+
+    def call(self, operation, kwargs):
+        names = kwargs.get('ExpressionAttributeNames') or {}
+        values = {k: self.deserializer.deserialize(v) for k, v in kwargs.pop('ExpressionAttributeValues', {}).items()}
+        for k in ('KeyConditionExpression', 'FilterExpression'):
+            if k in kwargs:
+                kwargs[k] = Parser(kwargs[k], names, values).parse()
+        if 'ExclusiveStartKey' in kwargs:
+            kwargs['ExclusiveStartKey'] = self.decode(kwargs['ExclusiveStartKey'])
+        response = operation(**kwargs)
+        if 'Items' in response:
+            response['Items'] = [self.encode(item) for item in response['Items']]
+        if 'LastEvaluatedKey' in response:
+            response['LastEvaluatedKey'] = self.encode(response['LastEvaluatedKey'])
+        return response
+
+    def encode(self, item):
+        return {k: self.serializer.serialize(v) for k, v in item.items()}
+
+    def decode(self, item):
+        return {k: self.deserializer.deserialize(v) for k, v in item.items()}
+
+    def __getattr__(self, name):
+        raise AttributeError('The memory backend only emulates client.scan and client.query, not client.{}'.format(
+            name
+        ))
+
+
+class Memory(object):
+    # in-process stand-in for boto3.resource('dynamodb'), see orm.connection.use()
+    def __init__(self, latency=0, throttle=0, retries=3, seed=None):
+        self.latency = latency
+        self.throttle = throttle
+        self.retries = retries
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.client = LowLevelClient(self)
+
+    def create_table(self, name, *models):
+        indexes = {}
+        for model in models:
+            for index in model.indexes:
+                indexes.setdefault(index.name, index)
+        with self.lock:
+            self.tables[name] = Table(self, name, indexes.values())
+        return self.tables[name]
+
+    def Table(self, name):
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = Table(self, name)
+            return self.tables[name]
+
+    def call(self, operation):
+        # per call latency (seconds or a callable) and throttling retried like botocore would, up to self.retries
+        attempts = 0
+        while True:
+            latency = self.latency() if callable(self.latency) else self.latency
+            if latency:
+                time.sleep(latency)
+            if not self.throttle or self.random.random() >= self.throttle:
+                return attempts
+            if attempts == self.retries:
+                raise error('ProvisionedThroughputExceededException', 'Throttled {}'.format(operation))
+            attempts += 1
+
+    def throttled(self):
+        return self.throttle and self.random.random() < self.throttle
+
+    def response(self, attempts, consumed=None, **data):
+        data['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RetryAttempts': attempts}
+        if consumed is not None:
+            data['ConsumedCapacity'] = consumed
+        return data
+
+    def batch_get_item(self, RequestItems, ReturnConsumedCapacity='NONE'):
+        attempts = self.call('batch_get_item')
+        if sum(len(request['Keys']) for request in RequestItems.values()) > 100:
+            raise error('ValidationException', 'Too many items requested for the BatchGetItem call')
+        responses = {}
+        unprocessed = {}
+        consumed = []
+        for name, request in RequestItems.items():
+            table = self.Table(name)
+            items = responses.setdefault(name, [])
+            units = 0
+            for key in request['Keys']:
+                if self.throttled():
+                    unprocessed.setdefault(name, dict(request, Keys=[]))['Keys'].append(key)
+                    continue
+                entry = table.entry(key)
+                if entry:
+                    units += table.read_units(entry[1], request.get('ConsistentRead'))
+                    items.append(project(clone(entry[0]), request.get('ProjectionExpression'),
+                                         request.get('ExpressionAttributeNames')))
+            consumed.append({'TableName': name, 'CapacityUnits': units})
+        return self.response(
+            attempts, consumed if ReturnConsumedCapacity != 'NONE' else None,
+            Responses=responses, UnprocessedKeys=unprocessed
+        )
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity='NONE'):
+        attempts = self.call('batch_write_item')
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise error('ValidationException', 'Too many items requested for the BatchWriteItem call')
+        unprocessed = {}
+        consumed = []
+        for name, requests in RequestItems.items():
+            table = self.Table(name)
+            units = 0
+            for request in requests:
+                if self.throttled():
+                    unprocessed.setdefault(name, []).append(request)
+                elif 'PutRequest' in request:
+                    units += table.put(request['PutRequest']['Item'])
+                else:
+                    units += table.remove(request['DeleteRequest']['Key'])
+            consumed.append({'TableName': name, 'CapacityUnits': units})
+        return self.response(
+            attempts, consumed if ReturnConsumedCapacity != 'NONE' else None, UnprocessedItems=unprocessed
+        )
+
+
+class Table(object):
+    def __init__(self, backend, name, indexes=()):
+        self.backend = backend
+        self.name = name
+        self.indexes = {index.name: index for index in indexes}
+        self.lock = threading.RLock()
+        self.items = {}
+        # scan order: key -> position in sequence, deleted keys leave a hole so their position stays resolvable
+        self.order = {}
+        self.sequence = []
+        # query partitions: (index name, hash value) -> keys, None stands for the table itself
+        self.partitions = {}
+        self.sorted = {}
+
+    def keys(self, index_name):
+        if index_name is None:
+            return 'pk', 'model'
+        return self.indexes[index_name].keys
+
+    def key(self, item):
+        return item['pk'], item['model']
+
+    def entry(self, key):
+        return self.items.get((key['pk'], key['model']))
+
+    def read_units(self, item_size, consistent=False):
+        return math.ceil(item_size / 4096) * (1 if consistent else 0.5)
+
+    def partition_keys(self, item):
+        for index_name in (None,) + tuple(self.indexes):
+            attrs = self.keys(index_name)
+            if all(attr in item for attr in attrs):
+                yield index_name, item[attrs[0]]
+
+    def put(self, item):
+        item = normalize(item)
+        key = self.key(item)
+        item_size = size(item)
+        with self.lock:
+            self.unlink(key)
+            self.items[key] = item, item_size
+            if self.order.get(key) is None or self.sequence[self.order[key]] is None:
+                self.order[key] = len(self.sequence)
+                self.sequence.append(key)
+            for partition in self.partition_keys(item):
+                self.partitions.setdefault(partition, set()).add(key)
+                self.sorted.pop(partition, None)
+        return math.ceil(item_size / 1024)
+
+    def unlink(self, key):
+        entry = self.items.pop(key, None)
+        if entry:
+            for partition in self.partition_keys(entry[0]):
+                self.partitions[partition].discard(key)
+                self.sorted.pop(partition, None)
+        return entry
+
+    def remove(self, key):
+        key = key['pk'], key['model']
+        with self.lock:
+            entry = self.unlink(key)
+            if entry:
+                self.sequence[self.order[key]] = None
+        return math.ceil(entry[1] / 1024) if entry else 1
+
+    def put_item(self, Item, ReturnConsumedCapacity='NONE'):
+        attempts = self.backend.call('put_item')
+        units = self.put(Item)
+        return self.backend.response(attempts, self.consumed(units, ReturnConsumedCapacity))
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, ConsistentRead=False,
+                 ReturnConsumedCapacity='NONE'):
+        attempts = self.backend.call('get_item')
+        entry = self.entry(Key)
+        data = {}
+        units = 0.5
+        if entry:
+            units = self.read_units(entry[1], ConsistentRead)
+            data['Item'] = project(clone(entry[0]), ProjectionExpression, ExpressionAttributeNames)
+        return self.backend.response(attempts, self.consumed(units, ReturnConsumedCapacity), **data)
+
+    def delete_item(self, Key, ReturnValues='NONE', ReturnConsumedCapacity='NONE'):
+        attempts = self.backend.call('delete_item')
+        with self.lock:
+            entry = self.entry(Key)
+            units = self.remove(Key)
+        data = {}
+        if ReturnValues == 'ALL_OLD' and entry:
+            data['Attributes'] = clone(entry[0])
+        return self.backend.response(attempts, self.consumed(units, ReturnConsumedCapacity), **data)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    ReturnValues='NONE', ReturnConsumedCapacity='NONE'):
+        # SET path = :value [+|- :value], SET path = if_not_exists(path, :value), ADD path :value and REMOVE path
+        attempts = self.backend.call('update_item')
+        names = ExpressionAttributeNames or {}
+        values = normalize(ExpressionAttributeValues or {})
+        with self.lock:
+            entry = self.entry(Key)
+            old = entry[0] if entry else {}
+            item = clone(entry[0]) if entry else normalize(dict(Key))
+            updated = {}
+            for action, clause in re.findall(r'(?i)\b(SET|ADD|REMOVE)\s+(.*?)(?=\s+\b(?:SET|ADD|REMOVE)\b|$)',
+                                             UpdateExpression):
+                for assignment in re.split(r',(?![^(]*\))', clause):
+                    action = action.upper()
+                    if action == 'REMOVE':
+                        path = [names.get(token, token) for token in assignment.strip().split('.')]
+                        parent = resolve(item, path[:-1])
+                        if isinstance(parent, dict):
+                            parent.pop(path[-1], None)
+                        continue
+                    if action == 'SET':
+                        target, operand = [token.strip() for token in assignment.split('=', 1)]
+                    else:
+                        target, operand = assignment.split()
+                    path = [names.get(token, token) for token in target.split('.')]
+                    current = resolve(item, path)
+                    value = self.operand(operand, item, names, values)
+                    if action == 'ADD':
+                        if current is MISSING:
+                            current = set() if isinstance(value, set) else Decimal(0)
+                        value = current | value if isinstance(value, set) else current + value
+                    parent = item
+                    for token in path[:-1]:
+                        parent = parent.setdefault(token, {})
+                    parent[path[-1]] = value
+                    updated[path[0]] = item[path[0]]
+            units = self.put(item)
+        data = {}
+        if ReturnValues == 'ALL_NEW':
+            data['Attributes'] = clone(item)
+        elif ReturnValues == 'UPDATED_NEW':
+            data['Attributes'] = clone(updated)
+        elif ReturnValues == 'ALL_OLD' and old:
+            data['Attributes'] = clone(old)
+        elif ReturnValues == 'UPDATED_OLD':
+            data['Attributes'] = clone({k: old[k] for k in updated if k in old})
+        return self.backend.response(attempts, self.consumed(units, ReturnConsumedCapacity), **data)
+
+    def operand(self, operand, item, names, values):
+        match = re.match(r'if_not_exists\s*\(\s*([^,]+?)\s*,\s*(:\w+)\s*\)$', operand)
+        if match:
+            current = resolve(item, [names.get(token, token) for token in match.group(1).split('.')])
+            return values[match.group(2)] if current is MISSING else current
+        tokens = operand.split()
+        if len(tokens) == 3:
+            left = self.operand(tokens[0], item, names, values)
+            right = self.operand(tokens[2], item, names, values)
+            return left + right if tokens[1] == '+' else left - right
+        if operand.startswith(':'):
+            return values[operand]
+        return resolve(item, [names.get(token, token) for token in operand.split('.')])
+
+    def consumed(self, units, mode):
+        return {'TableName': self.name, 'CapacityUnits': units} if mode and mode != 'NONE' else None
+
+    def scan(self, FilterExpression=None, Limit=None, ExclusiveStartKey=None, ProjectionExpression=None,
+             ExpressionAttributeNames=None, Select=None, Segment=None, TotalSegments=None, IndexName=None,
+             ConsistentRead=False, ReturnConsumedCapacity='NONE'):
+        attempts = self.backend.call('scan')
+        with self.lock:
+            start = 0 if ExclusiveStartKey is None else self.order[self.key(ExclusiveStartKey)] + 1
+            keys = (key for key in self.sequence[start:] if key is not None)
+            if TotalSegments:
+                keys = (key for key in keys if zlib.crc32(key[0].encode()) % TotalSegments == Segment)
+            if IndexName:
+                attrs = self.keys(IndexName)
+                keys = (key for key in keys if key in self.items and all(a in self.items[key][0] for a in attrs))
+            data, units = self.page(
+                keys, None, FilterExpression, Limit, ProjectionExpression, ExpressionAttributeNames, Select,
+                IndexName, ConsistentRead
+            )
+        return self.backend.response(attempts, self.consumed(units, ReturnConsumedCapacity), **data)
+
+    def query(self, KeyConditionExpression, IndexName=None, FilterExpression=None, Limit=None,
+              ExclusiveStartKey=None, ProjectionExpression=None, ExpressionAttributeNames=None, Select=None,
+              ScanIndexForward=True, ConsistentRead=False, ReturnConsumedCapacity='NONE'):
+        attempts = self.backend.call('query')
+        attrs = self.keys(IndexName)
+        if FilterExpression is not None and attributes(FilterExpression) & set(attrs):
+            raise error('ValidationException', 'Filter Expression can only contain non-primary key attributes: '
+                                               'Primary key attributes: {}'.format(', '.join(attrs)))
+        hash_value = self.hash_value(KeyConditionExpression, attrs[0])
+        with self.lock:
+            partition = IndexName, hash_value
+            if partition not in self.sorted:
+                entries = sorted(
+                    (self.sort_key(self.items[key][0], attrs), key) for key in self.partitions.get(partition, ())
+                )
+                self.sorted[partition] = entries, [value for value, key in entries]
+            entries, values = self.sorted[partition]
+            # only the range of the sort key condition is read, like DynamoDB does
+            start, stop = self.bounds(KeyConditionExpression, attrs, values)
+            if ExclusiveStartKey is not None:
+                position = self.sort_key(normalize(ExclusiveStartKey), attrs), self.key(ExclusiveStartKey)
+                if ScanIndexForward:
+                    start = max(start, bisect_right(entries, position))
+                else:
+                    stop = min(stop, bisect_left(entries, position))
+            positions = range(start, stop) if ScanIndexForward else range(stop - 1, start - 1, -1)
+            keys = (entries[i][1] for i in positions)
+            data, units = self.page(
+                keys, KeyConditionExpression, FilterExpression, Limit, ProjectionExpression,
+                ExpressionAttributeNames, Select, IndexName, ConsistentRead
+            )
+        return self.backend.response(attempts, self.consumed(units, ReturnConsumedCapacity), **data)
+
+    def hash_value(self, condition, attr):
+        expression = condition.get_expression()
+        if expression['operator'] == 'AND':
+            value = self.hash_value(expression['values'][0], attr)
+            return self.hash_value(expression['values'][1], attr) if value is MISSING else value
+        values = expression['values']
+        if expression['operator'] == '=' and isinstance(values[0], AttributeBase) and values[0].name == attr:
+            return normalize(values[1])
+        return MISSING
+
+    def bounds(self, condition, attrs, values):
+        # positions of the sorted partition the sort key condition can match, the condition is still evaluated
+        if len(attrs) < 2:
+            return 0, len(values)
+        expression = condition.get_expression()
+        if expression['operator'] == 'AND':
+            start, stop = self.bounds(expression['values'][0], attrs, values)
+            other = self.bounds(expression['values'][1], attrs, values)
+            return max(start, other[0]), min(stop, other[1])
+        operator = expression['operator']
+        operands = expression['values']
+        if not isinstance(operands[0], AttributeBase) or operands[0].name != attrs[1]:
+            return 0, len(values)
+        operands = [normalize(value) for value in operands[1:]]
+        try:
+            if operator == '=':
+                return bisect_left(values, operands[0]), bisect_right(values, operands[0])
+            if operator in ('<', '<='):
+                return 0, (bisect_left if operator == '<' else bisect_right)(values, operands[0])
+            if operator in ('>', '>='):
+                return (bisect_right if operator == '>' else bisect_left)(values, operands[0]), len(values)
+            if operator == 'BETWEEN':
+                return bisect_left(values, operands[0]), bisect_right(values, operands[1])
+            if operator == 'begins_with' and operands[0]:
+                prefix = operands[0]
+                return bisect_left(values, prefix), bisect_left(values, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        except TypeError:
+            pass
+        return 0, len(values)
+
+    def sort_key(self, item, attrs):
+        return item[attrs[1]] if len(attrs) > 1 else ''
+
+    def page(self, keys, condition, exp, limit, expression, names, select, index_name, consistent):
+        # reads up to Limit items or 1MB, as DynamoDB does before applying the filter
+        index = self.indexes.get(index_name)
+        projected = index.projected() if index else None
+        items = []
+        count = scanned = total_size = 0
+        last = None
+        for key in keys:
+            entry = self.items.get(key)
+            if entry is None or (condition is not None and not evaluate(condition, entry[0])):
+                continue
+            if (limit and scanned >= limit) or total_size >= PAGE_SIZE:
+                break
+            item, item_size = entry
+            scanned += 1
+            total_size += item_size
+            last = key
+            if projected is not None:
+                item = {k: v for k, v in item.items() if k in projected}
+            if exp is None or evaluate(exp, item):
+                count += 1
+                if select != 'COUNT':
+                    items.append(project(clone(item), expression, names))
+        else:
+            last = None
+        data = {'Count': count, 'ScannedCount': scanned}
+        if select != 'COUNT':
+            data['Items'] = items
+        if last is not None:
+            item = self.items[last][0]
+            attrs = set(self.keys(None) + (self.keys(index_name) if index_name else ()))
+            data['LastEvaluatedKey'] = {attr: item[attr] for attr in attrs}
+        units = self.read_units(total_size, consistent) if total_size else 0.5
+        return data, units
@@ -1,23 +1,380 @@
+import asyncio
+import base64
+import copy
+import functools
+import hashlib
+import hmac
 import json
+import operator
 import os
-from collections import UserDict
-from collections.abc import Sequence
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict, UserDict
+from collections.abc import MutableMapping, Sequence
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED, FIRST_COMPLETED
+from itertools import islice, repeat
 from uuid import uuid1
 
 import boto3
-from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.conditions import Key, Attr, ConditionExpressionBuilder
+from boto3.dynamodb.types import Binary, TypeDeserializer, TypeSerializer
+from botocore.config import Config
 from dotenv import load_dotenv
 
 load_dotenv()
 
+MISSING = object()
 
-dynamodb = boto3.resource(
-    'dynamodb',
-    aws_access_key_id=os.environ['KEY'],
-    aws_secret_access_key=os.environ['SECRET']
-)
 
-table = dynamodb.Table(os.environ['APP'])
+class Field(object):
+    def __init__(self, type=str):
+        self.type = type
+
+    def load(self, value):
+        if value is None or isinstance(value, self.type):
+            return value
+        return self.type(value)
+
+    def dump(self, value):
+        # boto3 only serializes numbers as Decimal
+        return Decimal(str(value)) if isinstance(value, float) else value
+
+
+class Reference(Field):
+    # pk, or list or set of pks, of items of another model (class or name); prefetch_related() loads them
+    # and puts the objects in place of the pks, which are written back when saving
+    def __init__(self, model):
+        super().__init__(str)
+        self.target = model
+
+    @property
+    def model(self):
+        return registry[self.target] if isinstance(self.target, str) else self.target
+
+    def load(self, value):
+        return value
+
+    def dump(self, value):
+        if isinstance(value, (list, set)):
+            return type(value)(self.dump(v) for v in value)
+        return value['pk'] if isinstance(value, Model) else value
+
+    def pks(self, value):
+        if value is None:
+            return ()
+        if isinstance(value, (list, set)):
+            return [pk for v in value for pk in self.pks(v)]
+        return (value['pk'] if isinstance(value, Model) else value,)
+
+    def resolve(self, value, objs):
+        if isinstance(value, (list, set)):
+            return [objs[pk] for pk in self.pks(value) if pk in objs]
+        return objs.get(self.pks(value)[0]) if value is not None else None
+
+
+# model classes by name, for references declared with a name
+registry = {}
+
+
+class Row(MutableMapping):
+    # compact storage for models with declared fields: one list slot per field, undeclared keys go to extra
+    __slots__ = ('values', 'extra')
+    fields = {}
+    index = {}
+
+    def __init__(self, data):
+        self.values = [MISSING] * len(self.index)
+        self.extra = None
+        for k, v in data.items():
+            self[k] = v
+
+    def __getitem__(self, key):
+        i = self.index.get(key)
+        if i is not None and self.values[i] is not MISSING:
+            return self.values[i]
+        if i is None and self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        i = self.index.get(key)
+        if i is None:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+        else:
+            self.values[i] = self.fields[key].load(value)
+
+    def __delitem__(self, key):
+        i = self.index.get(key)
+        if i is None:
+            del (self.extra or {})[key]
+        elif self.values[i] is MISSING:
+            raise KeyError(key)
+        else:
+            self.values[i] = MISSING
+
+    def __iter__(self):
+        for k, i in self.index.items():
+            if self.values[i] is not MISSING:
+                yield k
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return dict(self)
+
+    def __reduce__(self):
+        # the loaded values are restored as they are, the class is found as the row attribute of its model
+        values = {k: self.values[i] for k, i in self.index.items() if self.values[i] is not MISSING}
+        return type(self), ({},), (values, self.extra)
+
+    def __setstate__(self, state):
+        values, self.extra = state
+        for k, v in values.items():
+            self.values[self.index[k]] = v
+
+
+class Metrics(object):
+    # every DynamoDB call is recorded here: totals per (operation, table, index) until reset, plus optional listeners
+    READS = ('get_item', 'batch_get_item', 'scan', 'query')
+
+    def __init__(self, slow=None, expensive=None, namespace='orm'):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.listeners = []
+        self.connect = 0
+        self.slow = slow
+        self.expensive = expensive
+        self.namespace = namespace
+
+    def configure(self, slow=None, expensive=None, namespace='orm'):
+        # slow in seconds and expensive in capacity units, calls above them are logged with their query
+        self.slow = slow
+        self.expensive = expensive
+        self.namespace = namespace
+
+    def call(self, operation, func, table=None, index=None, query=None, retries=0, **kwargs):
+        start = time.perf_counter()
+        response = func(ReturnConsumedCapacity='TOTAL', **kwargs)
+        self.record(operation, response, time.perf_counter() - start, table, index, query, retries)
+        return response
+
+    def record(self, operation, response, latency, table=None, index=None, query=None, retries=0):
+        consumed = response.get('ConsumedCapacity') or []
+        units = sum(c.get('CapacityUnits', 0) for c in ([consumed] if isinstance(consumed, dict) else consumed))
+        if operation == 'get_item':
+            scanned = returned = int('Item' in response)
+        elif operation == 'batch_get_item':
+            scanned = returned = sum(len(items) for items in response.get('Responses', {}).values())
+        else:
+            scanned = response.get('ScannedCount', 0)
+            returned = response.get('Count', 0)
+        record = dict(
+            operation=operation, table=table, index=index,
+            rcu=units if operation in self.READS else 0, wcu=0 if operation in self.READS else units,
+            scanned=scanned, returned=returned, latency=latency,
+            retries=retries + response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        )
+        with self.lock:
+            totals = self.totals.setdefault((operation, table, index), dict.fromkeys(
+                ('calls', 'rcu', 'wcu', 'scanned', 'returned', 'latency', 'retries'), 0
+            ))
+            totals['calls'] += 1
+            for k in ('rcu', 'wcu', 'scanned', 'returned', 'latency', 'retries'):
+                totals[k] += record[k]
+        for listener in self.listeners:
+            listener(record)
+        if (self.slow and latency >= self.slow) or (self.expensive and units >= self.expensive):
+            print('Slow query {} {}: {:.3f}s {} CU {}/{} items, {}'.format(
+                operation, index or table, latency, units, returned, scanned, query or '-'
+            ))
+        return record
+
+    def connected(self, latency):
+        # the session and resource setup is not a DynamoDB call, it is reported apart from the operations
+        with self.lock:
+            self.connect += latency
+
+    def reset(self):
+        with self.lock:
+            self.totals = {}
+            self.connect = 0
+
+    def summary(self):
+        with self.lock:
+            totals = [dict(values, operation=k[0], table=k[1], index=k[2]) for k, values in self.totals.items()]
+            connect = self.connect
+        summary = dict.fromkeys(('calls', 'rcu', 'wcu', 'scanned', 'returned', 'latency', 'retries'), 0)
+        for values in totals:
+            for k in summary:
+                summary[k] += values[k]
+        summary['connect'] = connect
+        summary['operations'] = totals
+        return summary
+
+    def emit(self, emf=False, reset=True):
+        summary = self.summary()
+        if emf:
+            # CloudWatch embedded metric format, one metric set per call site
+            names = (('calls', 'Count'), ('rcu', 'Count'), ('wcu', 'Count'), ('scanned', 'Count'),
+                     ('returned', 'Count'), ('latency', 'Seconds'), ('retries', 'Count'))
+            for values in summary['operations']:
+                data = dict(values, table=values['table'] or '-', index=values['index'] or '-')
+                data['_aws'] = {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [['operation', 'table', 'index']],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, unit in names]
+                    }]
+                }
+                print(json.dumps(data, default=str))
+            if summary['connect']:
+                print(json.dumps({'connect': summary['connect'], '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace, 'Dimensions': [[]],
+                        'Metrics': [{'Name': 'connect', 'Unit': 'Seconds'}]
+                    }]
+                }}))
+        else:
+            print(json.dumps(summary, default=str))
+        if reset:
+            self.reset()
+        return summary
+
+    def handler(self, func):
+        # decorates a lambda handler so that each invocation is logged as one line
+        @functools.wraps(func)
+        def wrapper(event, context):
+            self.reset()
+            try:
+                return func(event, context)
+            finally:
+                self.emit()
+        return wrapper
+
+
+metrics = Metrics()
+
+
+class Table(object):
+    # the Table resource calls made through the resource's client: it (de)serializes python values the same way and,
+    # unlike resources, is thread-safe
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def put_item(self, **kwargs):
+        return self.client.put_item(TableName=self.name, **kwargs)
+
+    def get_item(self, **kwargs):
+        return self.client.get_item(TableName=self.name, **kwargs)
+
+    def update_item(self, **kwargs):
+        return self.client.update_item(TableName=self.name, **kwargs)
+
+    def delete_item(self, **kwargs):
+        return self.client.delete_item(TableName=self.name, **kwargs)
+
+    def scan(self, **kwargs):
+        return self.client.scan(TableName=self.name, **kwargs)
+
+    def query(self, **kwargs):
+        return self.client.query(TableName=self.name, **kwargs)
+
+
+class Connection(object):
+    # the boto3 session and resource are only created by the first request that needs them
+    def __init__(self, **options):
+        self.lock = threading.Lock()
+        self.session = None
+        self.resource = None
+        self.backend = None
+        self.low_level = None
+        self.tables = {}
+        self.elapsed = None
+        self.options = dict(
+            max_pool_connections=50, connect_timeout=2, read_timeout=10, tcp_keepalive=True,
+            retries={'max_attempts': 5, 'mode': 'standard'}
+        )
+        self.options.update(options)
+
+    def configure(self, **options):
+        with self.lock:
+            self.options.update(options)
+            self.session = None
+            self.resource = None
+            self.backend = None
+            self.low_level = None
+            self.tables = {}
+
+    def use(self, backend):
+        # replaces boto3 with another implementation of the dynamodb resource api, e.g. memory.Memory
+        with self.lock:
+            self.resource = backend
+            self.backend = backend
+            self.low_level = backend.client
+            self.tables = {}
+
+    @property
+    def dynamodb(self):
+        if self.resource is None:
+            with self.lock:
+                if self.resource is None:
+                    start = time.perf_counter()
+                    self.resource = self.get_session().resource('dynamodb', config=Config(**self.options))
+                    self.elapsed = time.perf_counter() - start
+                    metrics.connected(self.elapsed)
+        return self.resource
+
+    @property
+    def client(self):
+        # plain client, the one in resource.meta has the resource layer (de)serialization hooks registered
+        if self.low_level is None:
+            with self.lock:
+                if self.low_level is None:
+                    self.low_level = self.get_session().client('dynamodb', config=Config(**self.options))
+        return self.low_level
+
+    def get_session(self):
+        if self.session is None:
+            self.session = boto3.session.Session(
+                aws_access_key_id=os.environ.get('KEY'),
+                aws_secret_access_key=os.environ.get('SECRET'),
+                region_name=os.environ.get('REGION')
+            )
+        return self.session
+
+    @property
+    def api(self):
+        # what the batch calls go through, a backend set with use() is called directly
+        return self.backend or self.dynamodb.meta.client
+
+    def table(self, name=None):
+        name = name or os.environ['APP']
+        if name not in self.tables:
+            self.tables[name] = self.backend.Table(name) if self.backend else Table(self.dynamodb.meta.client, name)
+        return self.tables[name]
+
+
+connection = Connection()
+
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+RETRIES = 8
+# invalidated keys remembered individually by the cache, older invalidations only as a floor version
+INVALIDATED = 10000
 
 OPERATORS = {
     'eq': '=',
@@ -26,29 +383,322 @@ OPERATORS = {
     'gt': '>',
     'gte': '>=',
 }
+COMPARE = {'lt': operator.lt, 'gt': operator.gt}
 
 
-def where(k, v):
+def lookup(k):
     tokens = k.split('__')
     token = tokens.pop()
-    op = OPERATORS.get(token)
-    if op is None:
-        op = '='
-        tokens.append(token)
-    return '{} {} {}'.format('__'.join(tokens), op, v)
+    if token in OPERATORS.keys():
+        return '.'.join(tokens), token
+    tokens.append(token)
+    return '.'.join(tokens), 'eq'
+
+
+def where(k, v):
+    attr, name = lookup(k)
+    return '{} {} {}'.format(attr.replace('.', '__'), OPERATORS[name], v)
+
 
 def expression(k, v):
-    name = 'eq'
-    tokens = k.split('__')
-    token = tokens.pop()
-    if token in OPERATORS.keys():
-        name = token
-    else:
-        tokens.append(token)
-    func = getattr(Attr('.'.join(tokens)), name)
+    attr, name = lookup(k)
+    func = getattr(Attr(attr), name)
     return func(v)
 
 
+def projection(attrs):
+    # positional placeholders, attribute names may hold characters placeholders can't (and #n is the builder's)
+    placeholders = {}
+    paths = []
+    for attr in attrs:
+        tokens = []
+        for token in attr.split('__'):
+            tokens.append(placeholders.setdefault(token, '#p{}'.format(len(placeholders))))
+        paths.append('.'.join(tokens))
+    return ','.join(paths), {name: token for token, name in placeholders.items()}
+
+
+def getter(attr, field=None):
+    # reads an a__b path from a raw item, None when missing; field coerces top level declared attributes
+    path = attr.split('__')
+    if len(path) == 1:
+        if field is None:
+            return lambda item: item.get(attr)
+        load = field.load
+        return lambda item: load(item.get(attr))
+
+    def get(item):
+        for part in path:
+            item = item.get(part) if isinstance(item, dict) else None
+        return item
+    return get
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def backoff(attempt, base=0.05, cap=5):
+    time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+
+
+def drain(futures, return_when=FIRST_COMPLETED):
+    done, pending = wait(futures, return_when=return_when)
+    for future in done:
+        future.result()
+    return pending
+
+
+def number(value):
+    return float(value) if '.' in value or 'e' in value or 'E' in value else int(value)
+
+
+def cursor_secret():
+    # cursors are signed with their own secret, never with the AWS secret key; an empty one would let anyone forge them
+    secret = os.environ.get('CURSOR_SECRET')
+    if not secret:
+        raise RuntimeError('Set CURSOR_SECRET to sign pagination cursors')
+    return secret.encode()
+
+
+def dump_cursor(key, scope):
+    # URL-safe '<key>.<signature>', the key in AttributeValue form and the signature bound to the query plan
+    serializer = TypeSerializer()
+    payload = json.dumps(
+        {k: serializer.serialize(Decimal(str(v)) if isinstance(v, float) else v) for k, v in key.items()},
+        sort_keys=True, separators=(',', ':')
+    ).encode()
+    signature = hmac.new(cursor_secret(), scope.encode() + b'.' + payload, hashlib.sha256).digest()[:16]
+    return '{}.{}'.format(*(base64.urlsafe_b64encode(part).rstrip(b'=').decode() for part in (payload, signature)))
+
+
+def load_cursor(cursor, scope):
+    try:
+        payload, signature = (
+            base64.urlsafe_b64decode(part + '=' * (-len(part) % 4)) for part in cursor.split('.')
+        )
+        expected = hmac.new(cursor_secret(), scope.encode() + b'.' + payload, hashlib.sha256).digest()[:16]
+        if not hmac.compare_digest(signature, expected):
+            raise ValueError
+        return json.loads(payload)
+    except ValueError:
+        raise ValueError('Invalid cursor') from None
+
+
+NUMBERS = {'decimal': Decimal, 'float': float, 'auto': number}
+
+
+def decoder(numbers='decimal'):
+    # flat replacement for boto3's TypeDeserializer, numbers are decoded by NUMBERS[numbers] or a callable
+    parse = NUMBERS.get(numbers, numbers)
+
+    def value(v):
+        for tag, data in v.items():
+            if tag == 'S':
+                return data
+            if tag == 'N':
+                return parse(data)
+            if tag == 'M':
+                return {k: value(x) for k, x in data.items()}
+            if tag == 'L':
+                return [value(x) for x in data]
+            if tag == 'BOOL':
+                return data
+            if tag == 'NULL':
+                return None
+            if tag == 'SS':
+                return set(data)
+            if tag == 'NS':
+                return set(map(parse, data))
+            if tag == 'B':
+                return Binary(data)
+            if tag == 'BS':
+                return set(map(Binary, data))
+            raise TypeError('Unknown DynamoDB type {}'.format(tag))
+
+    def item(data):
+        return {k: value(v) for k, v in data.items()}
+    return item
+
+
+class Index(object):
+    # hash/range are the key attributes, 'model' stands for the model name; local indexes share the table's pk
+    def __init__(self, name, hash='model', range=None, projection='ALL', include=(), local=False,
+                 types=None, read=1, write=1):
+        self.name = name
+        self.hash = 'pk' if local else hash
+        self.range = range
+        self.projection = projection
+        self.include = tuple(include)
+        self.local = local
+        self.types = types or {}
+        self.read = read
+        self.write = write
+
+    @property
+    def keys(self):
+        return (self.hash, self.range) if self.range else (self.hash,)
+
+    def projected(self):
+        if self.projection == 'ALL':
+            return None
+        return {'pk', 'model'}.union(self.keys, self.include if self.projection == 'INCLUDE' else ())
+
+    def definition(self, provisioned=True):
+        definition = {
+            'IndexName': self.name,
+            'KeySchema': [
+                {'AttributeName': attr, 'KeyType': key_type} for attr, key_type in zip(self.keys, ('HASH', 'RANGE'))
+            ],
+            'Projection': {'ProjectionType': self.projection}
+        }
+        if self.projection == 'INCLUDE':
+            definition['Projection']['NonKeyAttributes'] = list(self.include)
+        if provisioned and not self.local:
+            definition['ProvisionedThroughput'] = {'ReadCapacityUnits': self.read, 'WriteCapacityUnits': self.write}
+        return definition
+
+    def attributes(self, model=None):
+        attributes = []
+        for attr in self.keys:
+            attr_type = self.types.get(attr)
+            if attr_type is None:
+                field = (model and model.fields or {}).get(attr)
+                attr_type = 'N' if field and field.type in (int, float, Decimal) else 'S'
+            attributes.append({'AttributeName': attr, 'AttributeType': attr_type})
+        return attributes
+
+
+class Counter(object):
+    # item counts of a model kept in `shards` counter items of its table and updated with ADD, so concurrent
+    # writers never conflict and no single key gets all the writes; group also counts the items per attribute value
+    def __init__(self, group=None, shards=8):
+        self.group = group
+        self.shards = shards
+        self.model = None
+
+    def bind(self, model):
+        counter = Counter(self.group, self.shards)
+        counter.model = model
+        return counter
+
+    def key(self, shard):
+        # the model attribute differs from the model name, so scans and queries of the model never see these items
+        return {'pk': 'count#{}'.format(shard), 'model': '{}#count'.format(self.model.__name__)}
+
+    def attr(self, value):
+        return '{}#{}'.format(self.group, value)
+
+    def deltas(self, items, sign=1):
+        deltas = {'count': 0}
+        for item in items:
+            deltas['count'] += sign
+            value = item.get(self.group) if self.group else None
+            if value is not None:
+                attr = self.attr(value)
+                deltas[attr] = deltas.get(attr, 0) + sign
+        return deltas
+
+    def add(self, deltas):
+        deltas = [(k, v) for k, v in deltas.items() if v]
+        if not deltas:
+            return
+        qs = self.model.objects
+        metrics.call(
+            'update_item', qs.table.update_item, qs.table_name,
+            Key=self.key(random.randrange(self.shards)),
+            UpdateExpression='ADD {}'.format(', '.join('#c{0} :c{0}'.format(i) for i in range(len(deltas)))),
+            ExpressionAttributeNames={'#c{}'.format(i): k for i, (k, v) in enumerate(deltas)},
+            ExpressionAttributeValues={':c{}'.format(i): v for i, (k, v) in enumerate(deltas)}
+        )
+
+    def read(self):
+        qs = self.model.objects
+        totals = {}
+        items = qs.batch_get(
+            ['count#{}'.format(shard) for shard in range(self.shards)], {'ConsistentRead': False},
+            model=self.key(0)['model']
+        )
+        for item in items:
+            for k, v in item.items():
+                if k not in ('pk', 'model'):
+                    totals[k] = totals.get(k, 0) + int(v)
+        return totals
+
+    def count(self):
+        return self.read().get('count', 0)
+
+    def counts(self):
+        prefix = self.attr('')
+        field = (self.model.fields or {}).get(self.group)
+        load = field.load if field and field.type in (int, float, Decimal) else str
+        return {load(k[len(prefix):]): v for k, v in self.read().items() if k.startswith(prefix) and v}
+
+    def rebuild(self, segments=8, workers=None):
+        # writes made while the scan runs may be missed, rebuild when the model is not being written to
+        qs = self.model.objects.parallel(segments, workers)
+        expression, names = projection(('pk', self.group) if self.group else ('pk',))
+        totals = self.deltas(
+            item for response in qs.pages(ProjectionExpression=expression, ExpressionAttributeNames=names)
+            for item in response['Items']
+        )
+        qs.batch_write(
+            {'PutRequest': {'Item': dict(self.key(shard), **(totals if shard == 0 else {}))}}
+            for shard in range(self.shards)
+        )
+        return totals['count']
+
+
+class Plan(object):
+    def __init__(self, table_name, exp=None, where=(), key=None, index=None, key_where=(), projected=None, post=()):
+        self.table_name = table_name
+        self.exp = exp
+        self.where = list(where)
+        self.key = key
+        self.index = index
+        self.key_where = list(key_where)
+        self.projected = projected
+        # (attr, op, value) exclusive range key bounds, read as BETWEEN and checked on the items
+        self.post = list(post)
+
+    def keep(self, item):
+        return all(attr in item and COMPARE[op](item[attr], value) for attr, op, value in self.post)
+
+    @property
+    def operation(self):
+        return 'scan' if self.key is None else 'query'
+
+    def covers(self, attrs):
+        # attrs None means the whole item
+        return self.projected is None or (attrs is not None and set(attrs) <= self.projected)
+
+    def kwargs(self):
+        kwargs = {}
+        if self.key is not None:
+            kwargs.update(KeyConditionExpression=self.key)
+        if self.index:
+            kwargs.update(IndexName=self.index)
+        if self.exp is not None:
+            kwargs.update(FilterExpression=self.exp)
+        return kwargs
+
+    def __str__(self):
+        tokens = [self.operation.upper(), self.table_name]
+        if self.index:
+            tokens.extend(['INDEX', self.index])
+        if self.key_where:
+            tokens.extend(['KEY', ' AND '.join(self.key_where)])
+        if self.where:
+            tokens.extend(['FILTER', ' AND '.join(self.where)])
+        if self.post:
+            tokens.extend(['AFTER', ' AND '.join('{} {} {}'.format(a, OPERATORS[op], v) for a, op, v in self.post)])
+        return ' '.join(tokens)
+
+
 class ClassPropertyDescriptor(object):
 
     def __init__(self, fget, fset=None):
@@ -79,91 +729,658 @@ def classproperty(func):
     return ClassPropertyDescriptor(func)
 
 
+class Cache(object):
+    # in-process (model, pk) -> item cache, disabled until configured and kept while the container is warm
+    def __init__(self, max_items=0, max_bytes=None, ttl=None):
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.bytes = 0
+        # every invalidation gets a new version, kept per key for the latest ones and as floor for older ones
+        self.versions = 0
+        self.invalidated = OrderedDict()
+        self.floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.configure(max_items, max_bytes, ttl)
+
+    def configure(self, max_items=1000, max_bytes=None, ttl=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clear()
+
+    @property
+    def enabled(self):
+        return bool(self.max_items or self.max_bytes)
+
+    def get(self, model, pk):
+        if not self.enabled:
+            return None
+        key = model.__name__, pk
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+        return model(**copy.deepcopy(entry[2]))
+
+    def version(self):
+        # taken before reading an item to cache, see set()
+        return self.versions
+
+    def set(self, obj, version=None):
+        # an item read before its last invalidation is stale: the write happened after the read
+        if not self.enabled:
+            return
+        key = type(obj).__name__, obj['pk']
+        ttl = self.ttl if obj.ttl is None else obj.ttl
+        data = copy.deepcopy(type(obj).dump(dict(obj.data)))
+        size = len(json.dumps(data, default=str))
+        with self.lock:
+            if version is not None and self.invalidated.get(key, self.floor) > version:
+                return
+            self.remove(key)
+            self.items[key] = None if ttl is None else time.monotonic() + ttl, size, data
+            self.bytes += size
+            while self.items and (
+                (self.max_items and len(self.items) > self.max_items) or (self.max_bytes and self.bytes > self.max_bytes)
+            ):
+                self.remove(next(iter(self.items)))
+
+    def remove(self, key):
+        entry = self.items.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def invalidate(self, model, pk):
+        if self.enabled:
+            key = model.__name__, pk
+            with self.lock:
+                self.remove(key)
+                self.versions += 1
+                self.invalidated.pop(key, None)
+                self.invalidated[key] = self.versions
+                while len(self.invalidated) > INVALIDATED:
+                    self.floor = self.invalidated.popitem(last=False)[1]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, items=len(self.items), bytes=self.bytes)
+
+
+cache = Cache()
+
+
+class Runner(object):
+    # runs the blocking boto3 calls of the async api, the number of workers bounds the concurrent requests
+    def __init__(self, workers=16):
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def configure(self, workers):
+        with self.lock:
+            if self.executor:
+                self.executor.shutdown(wait=False)
+            self.workers = workers
+            self.executor = None
+
+    async def run(self, func, *args, **kwargs):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            executor = self.executor
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+runner = Runner()
+
+
+class Aggregate(object):
+    # running accumulator: start() state, add() a value, merge() partial states (e.g. of parallel segments)
+    # and result(); missing values are skipped
+    function = None
+
+    def __init__(self, attr=None):
+        self.attr = attr
+
+    @property
+    def name(self):
+        return '{}__{}'.format(self.attr, self.function) if self.attr else self.function
+
+    def start(self):
+        return None
+
+    def add(self, state, value):
+        raise NotImplementedError
+
+    def merge(self, state, other):
+        return self.add(state, other)
+
+    def result(self, state):
+        return state
+
+
+class Count(Aggregate):
+    # Count() counts the items, Count(attr) the items that have attr
+    function = 'count'
+
+    def start(self):
+        return 0
+
+    def add(self, state, value):
+        return state + 1
+
+    def merge(self, state, other):
+        return state + other
+
+
+class Sum(Aggregate):
+    function = 'sum'
+
+    def start(self):
+        return 0
+
+    def add(self, state, value):
+        return state + value
+
+
+class Avg(Aggregate):
+    function = 'avg'
+
+    def start(self):
+        return [0, 0]
+
+    def add(self, state, value):
+        state[0] += value
+        state[1] += 1
+        return state
+
+    def merge(self, state, other):
+        return [state[0] + other[0], state[1] + other[1]]
+
+    def result(self, state):
+        return state[0] / state[1] if state[1] else None
+
+
+class Min(Aggregate):
+    function = 'min'
+
+    def add(self, state, value):
+        return value if state is None or (value is not None and value < state) else state
+
+
+class Max(Aggregate):
+    function = 'max'
+
+    def add(self, state, value):
+        return value if state is None or (value is not None and value > state) else state
+
+
+class Page(list):
+    # objects of one page and the cursor of the next one, None on the last page
+    def __init__(self, items, cursor=None):
+        super().__init__(items)
+        self.cursor = cursor
+
+
 class QuerySet(Sequence):
     def __init__(self, model):
         self.items = None
         self.model = model
         self.exp = expression('model', self.model.__name__)
         self.attrs = None
-        self.max = 10
+        self.shape = None
+        self.related = ()
+        self.annotations = None
+        self.max = None
+        self.size = None
+        self.prefetch = False
+        self.segments = 1
+        self.workers = None
+        self.ordered = False
+        self.numbers = None
         self.total = 0
+        self.scanned = 0
         self.where = ['model = {}'.format(self.model.__name__)]
+        self.conditions = []
+        self.disjunction = False
 
     def clone(self):
         qs = QuerySet(self.model)
         qs.exp = self.exp
         qs.attrs = self.attrs
-        qs.where = self.where
+        qs.shape = self.shape
+        qs.related = self.related
+        qs.annotations = self.annotations
+        qs.max = self.max
+        qs.size = self.size
+        qs.prefetch = self.prefetch
+        qs.segments = self.segments
+        qs.workers = self.workers
+        qs.ordered = self.ordered
+        qs.numbers = self.numbers
+        qs.where = list(self.where)
+        qs.conditions = list(self.conditions)
+        qs.disjunction = self.disjunction
         return qs
 
+    @property
+    def table_name(self):
+        return self.model.table_name or os.environ['APP']
+
+    @property
+    def table(self):
+        return connection.table(self.model.table_name)
+
     @property
     def query(self):
-        return 'SELECT {} FROM {} WHERE {}'.format(self.attrs or '*', table.name, ' AND '.join(self.where))
+        attrs = ','.join(attr.replace('__', '.') for attr in self.attrs) if self.attrs else '*'
+        return 'SELECT {} FROM {} WHERE {}'.format(attrs, self.table_name, ' AND '.join(self.where))
+
+    def plan(self):
+        # the partition key or a declared index turns the scan into a query, other conditions are kept as filter
+        if not self.disjunction:
+            equalities = {}
+            conditions = {}
+            for i, (k, v, negated) in enumerate(self.conditions):
+                attr, op = lookup(k)
+                if not negated:
+                    conditions.setdefault(attr, []).append((i, k, v))
+                    if op == 'eq':
+                        equalities.setdefault(attr, (i, k, v))
+            if 'pk' in equalities:
+                plan = self.residual(*self.key(('pk', 'model'), equalities, conditions), keys=('pk', 'model'))
+                if plan:
+                    return plan
+            candidates = []
+            for index in self.model.indexes:
+                key = self.key(index.keys, equalities, conditions)
+                plan = key and self.residual(*key, index=index, keys=index.keys)
+                if plan:
+                    exact = all(lookup(self.conditions[i][0])[1] == 'eq' for i in key[0])
+                    candidates.append(((-len(key[0]), not exact, index.projection != 'ALL'), len(candidates), plan))
+            if candidates:
+                return min(candidates)[2]
+        return Plan(self.table_name, self.exp, self.where)
 
-    def put(self, item):
-        pk = uuid1().hex
-        item.update(pk=pk, model=self.model.__name__)
-        response = table.put_item(Item=item)
-        return pk if response['ResponseMetadata']['HTTPStatusCode'] == 200 else None
+    def key(self, keys, equalities, conditions):
+        # every key attribute must be constrained, otherwise items missing it would be left out of a sparse index
+        used = []
+        key = None
+        key_where = []
+        post = []
+        for n, attr in enumerate(keys):
+            if attr == 'model':
+                condition = Key('model').eq(self.model.__name__)
+                key_where.append('model = {}'.format(self.model.__name__))
+            elif attr in equalities:
+                i, k, v = equalities[attr]
+                used.append(i)
+                condition = Key(attr).eq(v)
+                key_where.append(where(k, v))
+            elif n and attr in conditions:
+                # a range key bounded on both sides is only usable as BETWEEN, the key can't be in the filter; the
+                # ends of exclusive bounds are dropped after reading
+                bounds = {}
+                for i, k, v in conditions[attr]:
+                    bounds.setdefault(lookup(k)[1], (i, k, v))
+                low = bounds.get('gte') or bounds.get('gt')
+                high = bounds.get('lte') or bounds.get('lt')
+                if low and high:
+                    used.extend((low[0], high[0]))
+                    condition = Key(attr).between(low[2], high[2])
+                    key_where.append('{} BETWEEN {} AND {}'.format(attr, low[2], high[2]))
+                    post.extend((attr, lookup(k)[1], v) for i, k, v in (low, high) if lookup(k)[1] in COMPARE)
+                else:
+                    i, k, v = conditions[attr][0]
+                    used.append(i)
+                    condition = getattr(Key(attr), lookup(k)[1])(v)
+                    key_where.append(where(k, v))
+            else:
+                return None
+            key = condition if key is None else key & condition
+        return used, key, key_where, post
+
+    def residual(self, used, key, key_where, post=(), index=None, keys=()):
+        exp = None
+        where_ = []
+        attrs = set()
+        if index and 'model' not in index.keys:
+            exp = expression('model', self.model.__name__)
+            where_.append('model = {}'.format(self.model.__name__))
+            attrs.add('model')
+        for i, (k, v, negated) in enumerate(self.conditions):
+            if i not in used:
+                attr = lookup(k)[0].split('.')[0]
+                if attr in keys:
+                    # DynamoDB rejects filter expressions on the key attributes of the query
+                    return None
+                condition = ~ expression(k, v) if negated else expression(k, v)
+                exp = condition if exp is None else exp & condition
+                where_.append('NOT {}'.format(where(k, v)) if negated else where(k, v))
+                attrs.add(attr)
+        plan = Plan(
+            self.table_name, exp, where_, key, index and index.name, key_where, index and index.projected(), post
+        )
+        # filters can only see the attributes projected into the index
+        return plan if plan.covers(attrs) else None
 
     def create(self, **kwargs):
-        pk = self.put(kwargs)
-        return self.model(**kwargs) if pk else None
+        kwargs.update(pk=uuid1().hex, model=self.model.__name__)
+        response = metrics.call('put_item', self.table.put_item, self.table_name, Item=self.model.dump(kwargs))
+        if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+            return None
+        if self.model.counter:
+            self.model.counter.add(self.model.counter.deltas([kwargs]))
+        return self.model(**kwargs)
+
+    def bulk_create(self, items, workers=4):
+        objs = []
+
+        counter = self.model.counter
+
+        def requests():
+            for item in items:
+                obj = item if isinstance(item, Model) else self.model(**item)
+                obj.data.update(pk=uuid1().hex, model=self.model.__name__)
+                objs.append(obj)
+                yield {'PutRequest': {'Item': self.model.dump(obj.data)}}, obj
+
+        def written(batch):
+            # counted per written batch, so a failure leaves the counter matching what was stored
+            if counter:
+                counter.add(counter.deltas(obj.data for obj in batch))
+
+        self.batch_write(requests(), workers, written)
+        return objs
+
+    def bulk_update(self, objs, fields=None, workers=4):
+        # BatchWriteItem can only replace whole items, so updating some fields is done with concurrent update_item.
+        # Objects of models with declared fields are read through a projection, replacing them would drop the
+        # attributes that were not read, so only the attributes they hold are updated. Replacing would also leave a
+        # grouped counter with the old group values, update_item returns them
+        counter = self.model.counter
+        if fields is None and not self.model.fields and not (counter and counter.group):
+            def requests():
+                for obj in objs:
+                    yield {'PutRequest': {'Item': self.model.dump(obj.data)}}, obj['pk']
+
+            def written(pks):
+                for pk in pks:
+                    cache.invalidate(self.model, pk)
+            self.batch_write(requests(), workers, written)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = set()
+                for obj in objs:
+                    kwargs = {k: obj[k] for k in fields} if fields is not None else {
+                        k: v for k, v in obj.data.items() if k not in ('pk', 'model')
+                    }
+                    if len(pending) >= workers * 2:
+                        pending = drain(pending)
+                    if kwargs:
+                        pending.add(executor.submit(obj.update, **kwargs))
+                drain(pending, ALL_COMPLETED)
+
+    def batch_write(self, requests, workers=4, written=None):
+        # requests are consumed lazily, at most two batches per worker are waiting to be sent. With written, requests
+        # are (request, value) pairs and each worker calls written with the values of a batch once it is written
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for chunk in chunks(requests, BATCH_WRITE_SIZE):
+                if len(pending) >= workers * 2:
+                    pending = drain(pending)
+                pending.add(executor.submit(self.write, chunk, written))
+            drain(pending, ALL_COMPLETED)
+
+    def write(self, requests, written=None):
+        if written:
+            values = [value for request, value in requests]
+            requests = [request for request, value in requests]
+        attempt = 0
+        while requests:
+            response = metrics.call(
+                'batch_write_item', connection.api.batch_write_item, self.table_name, retries=attempt,
+                RequestItems={self.table_name: requests}
+            )
+            unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if written:
+                # every call reports what it wrote, unprocessed items are matched back by value
+                done = [value for request, value in zip(requests, values) if request not in unprocessed]
+                values = [value for request, value in zip(requests, values) if request in unprocessed]
+                if done:
+                    written(done)
+            requests = unprocessed
+            if requests:
+                if attempt == RETRIES:
+                    raise RuntimeError('{} items left unprocessed by batch_write_item'.format(len(requests)))
+                backoff(attempt)
+                attempt += 1
 
     def get(self, pk):
-        response = table.get_item(Key={'pk': pk, 'model': self.model.__name__})
-        return self.model(**response.get('Item'))
+        obj = cache.get(self.model, pk)
+        if obj is None:
+            version = cache.version()
+            kwargs = {}
+            if self.model.fields:
+                expression, names = projection(self.model.fields)
+                kwargs.update(ProjectionExpression=expression, ExpressionAttributeNames=names)
+            response = metrics.call(
+                'get_item', self.table.get_item, self.table_name, Key={'pk': pk, 'model': self.model.__name__}, **kwargs
+            )
+            obj = self.model(**response.get('Item'))
+            cache.set(obj, version)
+        if self.related:
+            self.attach([obj], self.related)
+        return obj
 
     def filter(self, **kwargs):
+        qs = self.clone()
         for k, v in kwargs.items():
-            self.where.append(where(k, v))
-            self.exp = self.exp & expression(k, v)
-        return self.clone()
+            qs.where.append(where(k, v))
+            qs.exp = qs.exp & expression(k, v)
+            qs.conditions.append((k, v, False))
+        return qs
 
     def exclude(self, **kwargs):
+        qs = self.clone()
         for k, v in kwargs.items():
-            self.where.append(where(k, v))
-            self.exp = self.exp & ~ expression(k, v)
-        return self.clone()
-
-    def filter2(self, **kwargs):
-        response = table.query(
-            IndexName='sexo',
-            KeyConditionExpression=Key('model').eq(self.model.__name__) & Key('sexo').eq('M'),
-            ReturnConsumedCapacity='TOTAL'
-        )
-        print(response)
+            qs.where.append('NOT {}'.format(where(k, v)))
+            qs.exp = qs.exp & ~ expression(k, v)
+            qs.conditions.append((k, v, True))
+        return qs
 
     def values(self, *attrs):
-        self.attrs = ','.join(attr.replace('__', '.') for attr in attrs)
-        return self.clone()
+        qs = self.clone()
+        qs.attrs = attrs or None
+        qs.shape = 'dict'
+        return qs
 
     def values_list(self, *attrs, flat=False):
-        items = []
-        values = self.values(*attrs)
-        for value in values:
-            if flat:
-                items.append(value.get(attrs[0]))
-            else:
-                l = []
-                for k in attrs:
-                    l.append(value.get(k))
-                items.append(l)
-        return items
+        if flat and len(attrs) != 1:
+            raise TypeError('flat=True needs exactly one attribute')
+        if not attrs and not self.model.fields:
+            # the attributes of undeclared items come in no particular order, tuples need it to be given
+            raise TypeError('values_list() needs attributes when the model does not declare fields')
+        qs = self.clone()
+        qs.attrs = attrs or None
+        qs.shape = 'flat' if flat else 'tuple'
+        return qs
+
+    def prefetch_related(self, *lookups):
+        qs = self.clone()
+        qs.related = self.related + lookups
+        return qs
+
+    def attach(self, objs, lookups, workers=4):
+        # the pks referenced by the objects are loaded with concurrent batch gets (cached objects are reused) and
+        # replaced by the objects; 'a__b' lookups then prefetch b on the loaded objects
+        nested = {}
+        for lookup in lookups:
+            name, _, rest = lookup.partition('__')
+            nested.setdefault(name, []).extend([rest] if rest else [])
+        for name, rest in nested.items():
+            field = (self.model.fields or {}).get(name)
+            if not isinstance(field, Reference):
+                raise ValueError('{}.{} is not a Reference field'.format(self.model.__name__, name))
+            target = field.model
+            found = {}
+            missing = []
+            for pk in dict.fromkeys(pk for obj in objs for pk in field.pks(obj.get(name))):
+                obj = cache.get(target, pk)
+                if obj is None:
+                    missing.append(pk)
+                else:
+                    found[pk] = obj
+            if missing:
+                version = cache.version()
+                fetched = target.objects.fetch(missing, workers=workers)
+                for obj in fetched.values():
+                    cache.set(obj, version)
+                found.update(fetched)
+            for obj in objs:
+                if obj.get(name) is not None:
+                    obj.data[name] = field.resolve(obj.get(name), found)
+            if rest:
+                target.objects.attach(list(found.values()), rest, workers)
+
+    def hydrate(self, items):
+        objs = list(map(self.loader(), items))
+        if self.related and self.shape is None:
+            self.attach(objs, self.related)
+        return objs
+
+    def loader(self):
+        # what a raw item becomes: a Model, or for values()/values_list() a dict, tuple or value read straight
+        # from the item without building the Model
+        if self.shape is None:
+            return lambda item: self.model(**item)
+        fields = self.model.fields or {}
+        attrs = self.attrs or tuple(fields)
+        if not attrs:
+            return lambda item: item
+        getters = [getter(attr, fields.get(attr)) for attr in attrs]
+        if self.shape == 'flat':
+            return getters[0]
+        if self.shape == 'tuple':
+            return lambda item: tuple([get(item) for get in getters])
+        pairs = list(zip(attrs, getters))
+        return lambda item: {attr: get(item) for attr, get in pairs}
 
     def limit(self, max):
-        self.max = max
-        return self
+        qs = self.clone()
+        qs.max = max
+        return qs
+
+    def stream(self, size=None, prefetch=True):
+        qs = self.clone()
+        qs.size = size
+        qs.prefetch = prefetch
+        return qs
+
+    def raw(self, numbers='decimal'):
+        # scans and queries go through the low-level client and the decoder, see decoder() for the number options
+        qs = self.clone()
+        qs.numbers = numbers
+        return qs
+
+    def parallel(self, segments, workers=None, ordered=False):
+        qs = self.clone()
+        qs.segments = segments
+        qs.workers = workers
+        qs.ordered = ordered
+        return qs
 
     def first(self):
-        return self[0] if len(self) else None
+        for obj in self.limit(1):
+            return obj
+        return None
 
-    def delete(self):
-        with table.batch_writer() as batch:
-            for pk in self.values_list('pk', flat=True):
-                batch.delete_item(Key={'pk': pk, 'model': self.model.__name__})
+    def page(self, size, cursor=None):
+        # keyset pagination: the cursor holds the key of the last item returned, so deep pages cost the same
+        # as the first one; it only resumes the same query, segments are not used
+        if size < 1:
+            raise ValueError('Page size must be at least 1')
+        qs = self.clone()
+        qs.size = size
+        qs.max = None
+        qs.segments = 1
+        qs.prefetch = False
+        plan = qs.plan()
+        keys = list(dict.fromkeys(
+            ['pk', 'model'] + [attr for index in self.model.indexes if index.name == plan.index for attr in index.keys]
+        ))
+        if qs.attrs or self.model.fields:
+            qs.attrs = tuple(dict.fromkeys(list(qs.attrs or self.model.fields) + keys))
+        kwargs = {}
+        if cursor:
+            key = load_cursor(cursor, str(plan))
+            if set(key) != set(keys):
+                raise ValueError('Invalid cursor')
+            if self.numbers is None:
+                deserializer = TypeDeserializer()
+                key = {k: deserializer.deserialize(v) for k, v in key.items()}
+            kwargs.update(ExclusiveStartKey=key)
+        items = []
+        more = False
+        for response in qs.pages(**kwargs):
+            taken = response['Items'][:size - len(items)]
+            items.extend(taken)
+            if len(items) == size:
+                more = len(taken) < len(response['Items']) or 'LastEvaluatedKey' in response
+                break
+        cursor = dump_cursor({k: items[-1][k] for k in keys}, str(plan)) if more else None
+        return Page(self.hydrate(items), cursor)
+
+    def delete(self, workers=4):
+        # only the keys are read, from the same scan/query plan (and segments) used for iterating
+        deleted = 0
+        counter = self.model.counter
+        expression, names = projection(('pk', 'model', counter.group) if counter and counter.group else ('pk', 'model'))
+        items = (
+            item for response in self.pages(ProjectionExpression=expression, ExpressionAttributeNames=names)
+            for item in response['Items']
+        )
+
+        def requests():
+            nonlocal deleted
+            for item in islice(items, self.max):
+                deleted += 1
+                yield {'DeleteRequest': {'Key': {'pk': item['pk'], 'model': item['model']}}}, item
+
+        def written(batch):
+            for item in batch:
+                cache.invalidate(self.model, item['pk'])
+            if counter:
+                counter.add(counter.deltas(batch, -1))
+
+        self.batch_write(requests(), workers, written)
+        return deleted
+
+    def __iter__(self):
+        if self.items is not None:
+            yield from self.items
+        else:
+            yield from islice(self.iterator(), self.max)
 
     def __getitem__(self, index):
+        if self.items is None:
+            if isinstance(index, slice):
+                if (index.start or 0) >= 0 and (index.stop or 0) >= 0 and (index.step or 1) > 0:
+                    return list(islice(self, index.start, index.stop, index.step))
+            elif index >= 0:
+                for item in islice(self, index, None):
+                    return item
+                raise IndexError('QuerySet index out of range')
         return self.scan().items[index]
 
     def __len__(self):
@@ -173,38 +1390,376 @@ class QuerySet(Sequence):
         qs = self.clone()
         qs.exp = self.exp | other.exp
         qs.where = ['(({}) OR ({}))'.format(' AND '.join(self.where), ' AND '.join(other.where))]
+        qs.disjunction = True
         return qs
 
-    def fetch(self, pks):
-        response = dynamodb.batch_get_item(
-            RequestItems={
-                os.environ['APP']: {
-                    'Keys': [
-                        {'pk': pk, 'model': self.model.__name__} for pk in pks
-                    ], 'ConsistentRead': False
-                }
-            },
-            ReturnConsumedCapacity='TOTAL'
+    def fetch(self, pks, *attrs, workers=4):
+        # in_bulk-style: {pk: Model} for the given pks, missing items are left out
+        pks = list(dict.fromkeys(pks))
+        request = self.batch_request(attrs)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(self.batch_get, chunks(pks, BATCH_GET_SIZE), repeat(request))
+            return self.in_bulk(pks, results)
+
+    def batch_request(self, attrs):
+        request = {'ConsistentRead': False}
+        attrs = attrs or tuple(self.model.fields or ())
+        if attrs:
+            expression, names = projection(dict.fromkeys(('pk',) + attrs))
+            request.update(ProjectionExpression=expression, ExpressionAttributeNames=names)
+        return request
+
+    def in_bulk(self, pks, results):
+        items = {item['pk']: item for result in results for item in result}
+        return {pk: self.model(**items[pk]) for pk in pks if pk in items}
+
+    def batch_get(self, pks, request, model=None):
+        items = []
+        keys = [{'pk': pk, 'model': model or self.model.__name__} for pk in pks]
+        attempt = 0
+        while keys:
+            response = metrics.call(
+                'batch_get_item', connection.api.batch_get_item, self.table_name, retries=attempt,
+                RequestItems={self.table_name: dict(request, Keys=keys)}
+            )
+            items.extend(response['Responses'].get(self.table_name, ()))
+            keys = response.get('UnprocessedKeys', {}).get(self.table_name, {}).get('Keys', [])
+            if keys:
+                if attempt == RETRIES:
+                    raise RuntimeError('{} keys left unprocessed by batch_get_item'.format(len(keys)))
+                backoff(attempt)
+                attempt += 1
+        return items
+
+    def pages(self, **kwargs):
+        plan = self.plan()
+        kwargs.update(plan.kwargs())
+        if self.size:
+            kwargs.update(Limit=self.size)
+        elif self.max and plan.exp is None and not plan.post:
+            # without a filter every evaluated item is returned, so there is no need to read past the limit
+            kwargs.update(Limit=self.max)
+        request = None
+        bounded = list(dict.fromkeys(attr for attr, op, value in plan.post))
+        if plan.post and kwargs.get('Select') == 'COUNT':
+            # the items are needed to drop the excluded ends, only their keys are read
+            del kwargs['Select']
+            kwargs['ProjectionExpression'], kwargs['ExpressionAttributeNames'] = projection(['pk'] + bounded)
+        elif bounded and 'ProjectionExpression' in kwargs:
+            names = dict(kwargs['ExpressionAttributeNames'])
+            for n, attr in enumerate(attr for attr in bounded if attr not in names.values()):
+                names['#b{}'.format(n)] = attr
+                kwargs['ProjectionExpression'] += ',#b{}'.format(n)
+            kwargs['ExpressionAttributeNames'] = names
+        if 'Select' not in kwargs and 'ProjectionExpression' not in kwargs:
+            attrs = self.attrs or self.model.fields
+            if not plan.covers(attrs and {attr.split('__')[0] for attr in attrs}):
+                request = self.batch_request(tuple(attrs or ()))
+                attrs = ('pk',)
+            if attrs:
+                expression, names = projection(tuple(dict.fromkeys(tuple(attrs) + tuple(bounded))))
+                kwargs.update(ProjectionExpression=expression, ExpressionAttributeNames=names)
+        if plan.operation == 'scan' and self.segments > 1 and 'Segment' not in kwargs:
+            responses = self.segmented(kwargs)
+        else:
+            responses = self.paginate(plan.operation, kwargs, self.prefetch)
+        for response in responses:
+            if plan.post:
+                response['Items'] = [item for item in response['Items'] if plan.keep(item)]
+                response['Count'] = len(response['Items'])
+            if request:
+                response['Items'] = self.complete(response['Items'], request)
+            self.total += response['Count']
+            self.scanned += response['ScannedCount']
+            yield response
+
+    def complete(self, items, request, workers=4):
+        # the index does not project the requested attributes, so the items are fetched by key
+        pks = [item['pk'] for item in items]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(self.batch_get, chunks(pks, BATCH_GET_SIZE), repeat(request))
+            found = {item['pk']: item for result in results for item in result}
+        return [found[pk] for pk in pks if pk in found]
+
+    def paginate(self, operation, kwargs, prefetch=False):
+        # follows LastEvaluatedKey, optionally requesting the next page while the current one is consumed
+        request = functools.partial(
+            metrics.call, operation, getattr(self.table, operation) if self.numbers is None else self.client(operation),
+            self.table_name, kwargs.get('IndexName'), '{} [{}]'.format(self.query, self.plan())
         )
-        print(response)
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        future = executor.submit(request, **kwargs) if executor else None
+        try:
+            while True:
+                response = future.result() if future else request(**kwargs)
+                key = response.get('LastEvaluatedKey')
+                if key:
+                    kwargs = dict(kwargs, ExclusiveStartKey=key)
+                    if executor:
+                        future = executor.submit(request, **kwargs)
+                yield response
+                if not key:
+                    break
+        finally:
+            if executor:
+                future.cancel()
+                executor.shutdown(wait=False)
+
+    def client(self, operation):
+        call = getattr(connection.client, operation)
+        decode = decoder(self.numbers)
+        serializer = TypeSerializer()
+
+        def request(**kwargs):
+            builder = ConditionExpressionBuilder()
+            names = dict(kwargs.pop('ExpressionAttributeNames', {}))
+            values = {}
+            for k, is_key_condition in (('KeyConditionExpression', True), ('FilterExpression', False)):
+                if k in kwargs:
+                    expression = builder.build_expression(kwargs[k], is_key_condition=is_key_condition)
+                    kwargs[k] = expression.condition_expression
+                    names.update(expression.attribute_name_placeholders)
+                    for placeholder, v in expression.attribute_value_placeholders.items():
+                        values[placeholder] = serializer.serialize(v)
+            if names:
+                kwargs.update(ExpressionAttributeNames=names)
+            if values:
+                kwargs.update(ExpressionAttributeValues=values)
+            response = call(TableName=self.table_name, **kwargs)
+            if 'Items' in response:
+                response['Items'] = [decode(item) for item in response['Items']]
+            return response
+        return request
+
+    def segmented(self, kwargs):
+        # each segment is scanned by a worker that hands its pages over through a bounded queue
+        workers = self.workers or min(self.segments, 8)
+        stop = threading.Event()
+        if self.ordered:
+            queues = [queue.Queue(maxsize=2) for _ in range(self.segments)]
+        else:
+            queues = [queue.Queue(maxsize=2 * workers)] * self.segments
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def scan(segment):
+            if stop.is_set():
+                return
+            try:
+                for response in self.paginate('scan', dict(kwargs, Segment=segment, TotalSegments=self.segments)):
+                    if not put(queues[segment], response):
+                        return
+                put(queues[segment], None)
+            except Exception as e:
+                put(queues[segment], e)
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for segment in range(self.segments):
+                executor.submit(scan, segment)
+            for q in (queues if self.ordered else queues[:1]):
+                pending = 1 if self.ordered else self.segments
+                while pending:
+                    item = q.get()
+                    if item is None:
+                        pending -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def iterator(self):
+        if self.annotations:
+            yield from self.groups()
+            return
+        # related objects are prefetched a page at a time
+        if self.related and self.shape is None:
+            for response in self.pages():
+                yield from self.hydrate(response['Items'])
+            return
+        load = self.loader()
+        for response in self.pages():
+            yield from map(load, response['Items'])
 
     def scan(self):
         if self.items is None:
-            print('Scanning...')
-            kwargs = dict(FilterExpression=self.exp, Limit=self.max, ReturnConsumedCapacity='TOTAL')
-            if self.attrs:
-                kwargs.update(ProjectionExpression=self.attrs),
-            response = table.scan(**kwargs)
-            print(response)
-            self.total = response['ScannedCount'] + response['Count']
-            self.items = [self.model(**item) for item in response['Items']]
+            self.items = list(islice(self.iterator(), self.max))
         return self
 
     def all(self):
         return self
 
     def count(self):
-        return len(self)
+        if self.items is not None or self.annotations:
+            return len(self.scan().items)
+        if self.model.counter and not self.conditions and not self.disjunction:
+            total = self.model.counter.count()
+            return min(total, self.max) if self.max else total
+        total = 0
+        for response in self.pages(Select='COUNT'):
+            total += response['Count']
+            if self.max and total >= self.max:
+                return self.max
+        return total
+
+    def aggregate(self, *args, **kwargs):
+        # {name: result}, e.g. aggregate(Sum('idade'), media=Avg('idade')) -> {'idade__sum': ..., 'media': ...}
+        aggregates = dict({aggregate.name: aggregate for aggregate in args}, **kwargs)
+        if self.items is None and all(type(a) is Count and a.attr is None for a in aggregates.values()):
+            return dict.fromkeys(aggregates, self.count())
+        states = self.accumulate(aggregates.values()).get((), [a.start() for a in aggregates.values()])
+        return {name: a.result(state) for (name, a), state in zip(aggregates.items(), states)}
+
+    def annotate(self, *args, **kwargs):
+        # values('sexo').annotate(Count(), media=Avg('idade')) yields one dict per distinct sexo
+        if self.shape != 'dict' or not self.attrs:
+            raise TypeError('annotate() needs the attributes to group by, e.g. values(attr).annotate(...)')
+        qs = self.clone()
+        qs.annotations = dict(self.annotations or {}, **{a.name: a for a in args}, **kwargs)
+        return qs
+
+    def groups(self):
+        aggregates = self.annotations
+        for key, states in self.accumulate(aggregates.values(), self.attrs).items():
+            group = dict(zip(self.attrs, key))
+            group.update((name, a.result(state)) for (name, a), state in zip(aggregates.items(), states))
+            yield group
+
+    def accumulate(self, aggregates, group=()):
+        # {group key: [state per aggregate]}; only the grouped and aggregated attributes are projected and each
+        # parallel segment accumulates its own pages in its worker, the partial states are merged at the end
+        aggregates = list(aggregates)
+        fields = self.model.fields or {}
+        groupers = [getter(attr, fields.get(attr)) for attr in group]
+        getters = [getter(a.attr, fields.get(a.attr)) if a.attr else lambda item: True for a in aggregates]
+        qs = self.clone()
+        qs.attrs = tuple(dict.fromkeys(tuple(group) + tuple(a.attr for a in aggregates if a.attr))) or ('pk',)
+        qs.shape = None
+
+        def partial(items):
+            groups = {}
+            for item in items:
+                key = tuple([get(item) for get in groupers])
+                states = groups.get(key)
+                if states is None:
+                    states = groups[key] = [a.start() for a in aggregates]
+                for i, get in enumerate(getters):
+                    value = get(item)
+                    if value is not None:
+                        states[i] = aggregates[i].add(states[i], value)
+            return groups
+
+        def segment(n):
+            responses = qs.pages(Segment=n, TotalSegments=qs.segments)
+            return partial(item for response in responses for item in response['Items'])
+
+        if self.items is not None:
+            partials = [partial(dict(obj.data) if isinstance(obj, Model) else obj for obj in self.items)]
+        elif self.segments > 1 and not self.max and qs.plan().operation == 'scan':
+            with ThreadPoolExecutor(max_workers=self.workers or min(self.segments, 8)) as executor:
+                partials = list(executor.map(segment, range(self.segments)))
+        else:
+            items = (item for response in qs.pages() for item in response['Items'])
+            partials = [partial(islice(items, self.max))]
+        groups = partials[0]
+        for other in partials[1:]:
+            for key, states in other.items():
+                if key in groups:
+                    groups[key] = [a.merge(x, y) for a, x, y in zip(aggregates, groups[key], states)]
+                else:
+                    groups[key] = states
+        return groups
+
+    def count_by(self, attr=None):
+        # {value: count}, read from the counter items when unfiltered and grouped by the counter's attribute
+        counter = self.model.counter
+        attr = attr or counter and counter.group
+        if not attr:
+            raise ValueError('count_by needs an attribute or a Counter with a group')
+        if counter and counter.group == attr and not self.conditions and not self.disjunction and not self.max:
+            return counter.counts()
+        counts = {}
+        field = (self.model.fields or {}).get(attr)
+        expression, names = projection(('pk', attr))
+        items = (
+            item for response in self.pages(ProjectionExpression=expression, ExpressionAttributeNames=names)
+            for item in response['Items']
+        )
+        for item in islice(items, self.max):
+            value = item
+            for part in attr.split('__'):
+                value = value.get(part) if isinstance(value, dict) else None
+            if value is not None:
+                value = field.load(value) if field else value
+                counts[value] = counts.get(value, 0) + 1
+        return counts
+
+    def rebuild_counter(self, segments=8, workers=None):
+        if not self.model.counter:
+            raise ValueError('{} has no counter'.format(self.model.__name__))
+        return self.model.counter.rebuild(segments, workers)
+
+    # ASYNC
+    async def __aiter__(self):
+        if self.items is not None or self.annotations:
+            for obj in (self.items if self.items is not None else (await runner.run(self.scan)).items):
+                yield obj
+            return
+        count = 0
+        pages = self.pages()
+        try:
+            while not self.max or count < self.max:
+                response = await runner.run(next, pages, None)
+                if response is None:
+                    break
+                items = list(islice(response['Items'], self.max - count if self.max else None))
+                for obj in await runner.run(self.hydrate, items):
+                    count += 1
+                    yield obj
+        finally:
+            pages.close()
+
+    async def aget(self, pk):
+        return await runner.run(self.get, pk)
+
+    async def apage(self, size, cursor=None):
+        return await runner.run(self.page, size, cursor)
+
+    async def afirst(self):
+        return await runner.run(self.first)
+
+    async def acount(self):
+        return await runner.run(self.count)
+
+    async def aaggregate(self, *args, **kwargs):
+        return await runner.run(self.aggregate, *args, **kwargs)
+
+    async def afetch(self, pks, *attrs):
+        pks = list(dict.fromkeys(pks))
+        request = self.batch_request(attrs)
+        results = await asyncio.gather(
+            *(runner.run(self.batch_get, chunk, request) for chunk in chunks(pks, BATCH_GET_SIZE))
+        )
+        return self.in_bulk(pks, results)
+
+    async def acreate(self, **kwargs):
+        return await runner.run(self.create, **kwargs)
+
+    async def abulk_create(self, items):
+        return await runner.run(self.bulk_create, items)
+
+    async def adelete(self):
+        return await runner.run(self.delete)
 
     def __str__(self):
         return str(self.scan().items)
@@ -213,11 +1768,52 @@ class QuerySet(Sequence):
 
 
 class Model(UserDict):
+    # Index objects, or attribute names with a KEYS_ONLY GSI named after them (see ServerlessApp.create_index)
+    indexes = ()
+    # seconds an object stays in the cache, None uses the cache default
+    ttl = None
+    # table the model is stored in, None uses the APP environment variable
+    table_name = None
+    # optional {name: type, Field or referenced Model} schema, stored compactly, coerced on load and used as
+    # default projection
+    fields = None
+    # opt-in maintained counts: True, an attribute name to also count per value, or a Counter
+    counter = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        registry[cls.__name__] = cls
+        cls.indexes = tuple(
+            index if isinstance(index, Index) else Index(index, range=index, projection='KEYS_ONLY')
+            for index in cls.indexes
+        )
+        if cls.counter:
+            counter = cls.counter if isinstance(cls.counter, Counter) else Counter(
+                cls.counter if isinstance(cls.counter, str) else None
+            )
+            cls.counter = counter.bind(cls)
+        if cls.fields:
+            fields = {'pk': Field(str), 'model': Field(str)}
+            for k, v in cls.fields.items():
+                if isinstance(v, type) and issubclass(v, Model):
+                    v = Reference(v)
+                fields[k] = v if isinstance(v, Field) else Field(v)
+            cls.fields = fields
+            cls.row = type('{}Row'.format(cls.__name__), (Row,), dict(
+                __slots__=(), fields=fields, index={k: i for i, k in enumerate(fields)},
+                __module__=cls.__module__, __qualname__='{}.row'.format(cls.__qualname__)
+            ))
 
     def __init__(self, **data):
-        self.data = data
+        self.data = self.row(data) if self.fields else data
         self.changes = {}
 
+    @classmethod
+    def dump(cls, data):
+        if not cls.fields:
+            return data
+        return {k: cls.fields[k].dump(v) if k in cls.fields else v for k, v in data.items()}
+
     @classproperty
     def objects(cls) -> QuerySet:
         return QuerySet(cls)
@@ -231,14 +1827,35 @@ class Model(UserDict):
             self.update(**self.changes)
 
     def delete(self):
-        response = table.delete_item(Key={'pk': self['pk'], 'model': type(self).__name__})
+        qs = type(self).objects
+        counter = type(self).counter
+        # the old item tells whether there was anything to delete and which group it was counted in
+        kwargs = {'ReturnValues': 'ALL_OLD'} if counter else {}
+        response = metrics.call(
+            'delete_item', qs.table.delete_item, qs.table_name, Key={'pk': self['pk'], 'model': type(self).__name__},
+            **kwargs
+        )
+        # after the write, a concurrent get could otherwise cache the old item again
+        cache.invalidate(type(self), self['pk'])
+        if counter and 'Attributes' in response:
+            counter.add(counter.deltas([response['Attributes']], -1))
         return response['ResponseMetadata']['HTTPStatusCode'] == 200
 
     def __str__(self):
         return str(self.data)
         return json.dumps(self.data, indent=2, ensure_ascii=False, use_decimal=True)
 
+    async def asave(self):
+        return await runner.run(self.save)
+
+    async def adelete(self):
+        return await runner.run(self.delete)
+
+    async def aupdate(self, **kwargs):
+        return await runner.run(self.update, **kwargs)
+
     def update(self, **kwargs):
+        kwargs = self.dump(kwargs)
         update_expressions = []
         update_expression_names = {}
         update_expression_values = {}
@@ -249,13 +1866,21 @@ class Model(UserDict):
             update_expression_names[update_attr_key] = k
             update_expression_values[update_value_key] = v
         update_expression = 'set {}'.format(','.join(update_expressions))
-        print(update_expression)
-        print(update_expression_names)
-        print(update_expression_values)
-        table.update_item(
+        qs = type(self).objects
+        counter = type(self).counter
+        regroup = counter and counter.group in kwargs
+        response = metrics.call(
+            'update_item', qs.table.update_item, qs.table_name,
             Key={'pk': self['pk'], 'model': type(self).__name__},
             UpdateExpression=update_expression,
             ExpressionAttributeValues=update_expression_values,
             ExpressionAttributeNames=update_expression_names,
-            ReturnValues="UPDATED_NEW"
+            ReturnValues='UPDATED_OLD' if regroup else "UPDATED_NEW"
         )
+        cache.invalidate(type(self), self['pk'])
+        if regroup:
+            old = response.get('Attributes', {}).get(counter.group)
+            deltas = counter.deltas([{counter.group: kwargs[counter.group]}])
+            for k, v in counter.deltas([{counter.group: old}], -1).items():
+                deltas[k] = deltas.get(k, 0) + v
+            counter.add(deltas)
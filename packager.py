@@ -0,0 +1,312 @@
+import base64
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import zlib
+
+# build artifacts and files that never belong in a bundle
+EXCLUDE = (
+    '__pycache__', '*.pyc', '*.pyo', '.git', '.gitignore', '.env', '.build', '.DS_Store', '*.sqlite3', '.pytest_cache',
+    '.mypy_cache', '.venv', 'venv'
+)
+# installed files a layer never needs at runtime
+PRUNE = (
+    '__pycache__', '*.pyc', '*.pyo', 'tests', '*.pyi', '*.po', '*.c', '*.h', '*.pxd', '*.pyx', 'RECORD', 'INSTALLER',
+    'WHEEL', 'REQUESTED', 'direct_url.json'
+)
+# run by the target interpreter: compiles [source, pyc, archive name] entries read from stdin into unchecked-hash
+# pycs, which the runtime loads without checking the source, so they work on a read-only filesystem
+COMPILE = '''
+import json, py_compile, sys
+for source, cfile, name in json.load(sys.stdin):
+    py_compile.compile(
+        source, cfile=cfile, dfile=name, doraise=True, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH
+    )
+'''
+# 1980-01-01 00:00, the earliest date a zip entry can have
+DOS_DATE = (0 << 9) | (1 << 5) | 1
+DOS_TIME = 0
+# one pip download into the shared wheel cache at a time
+DOWNLOAD = threading.Lock()
+
+
+def matches(name, patterns):
+    # a pattern matches the archive name, any of its leading directories or any single path component
+    parts = name.split('/')
+    candidates = ['/'.join(parts[:i + 1]) for i in range(len(parts))] + parts
+    return any(fnmatch.fnmatchcase(candidate, pattern) for pattern in patterns for candidate in candidates)
+
+
+def interpreter(version):
+    # bytecode is specific to the Python version, so it is compiled by an interpreter of the runtime version
+    if '{}.{}'.format(*sys.version_info[:2]) == version:
+        return sys.executable
+    path = shutil.which('python{}'.format(version))
+    if path is None:
+        raise RuntimeError('python{} is needed to compile bytecode for the runtime'.format(version))
+    return path
+
+
+def sha256(data):
+    # base64 digest, the format Lambda reports as CodeSha256
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+class Packager(object):
+    # deterministic zip of files and directory trees: entries are sorted and have fixed timestamps and permissions,
+    # so the same sources always give the same bytes. Hashes (by size and mtime) and compressed entries (by
+    # content hash) are cached in cache_dir, so a rebuild only reads and compresses the files that changed.
+    # With a compile interpreter every module also gets an unchecked-hash pyc, and modules matching sourceless
+    # are shipped as pyc only
+    def __init__(self, *paths, include=('*',), exclude=EXCLUDE, cache_dir='.build/pack', level=9, compile=None,
+                 sourceless=()):
+        self.paths = paths
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.cache_dir = cache_dir
+        self.level = level
+        self.compile = compile
+        self.sourceless = tuple(sourceless)
+        self.compressed = 0
+        self.reused = 0
+
+    def files(self):
+        # {archive name: file path}, a file is stored under its name and a directory under its own name
+        files = {}
+        for path in self.paths:
+            path = os.path.normpath(path)
+            if not os.path.exists(path):
+                raise FileNotFoundError('Nothing to pack at {}'.format(path))
+            if os.path.isfile(path):
+                files[os.path.basename(path)] = path
+                continue
+            base = os.path.basename(path)
+            for root, dirs, names in os.walk(path):
+                rel = os.path.relpath(root, path)
+                prefix = base if rel == '.' else '{}/{}'.format(base, rel.replace(os.sep, '/'))
+                dirs[:] = [d for d in dirs if not matches('{}/{}'.format(prefix, d), self.exclude)]
+                for name in names:
+                    files['{}/{}'.format(prefix, name)] = os.path.join(root, name)
+        return {
+            name: path for name, path in sorted(files.items())
+            if matches(name, self.include) and not matches(name, self.exclude)
+        }
+
+    def load(self):
+        try:
+            with open(os.path.join(self.cache_dir, 'index.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'files': {}, 'blobs': {}}
+
+    def save(self, index):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        referenced = {entry[2] for entry in index['files'].values()}
+        index['blobs'] = {digest: blob for digest, blob in index['blobs'].items() if digest in referenced}
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.z') and name[:-2] not in referenced:
+                os.remove(os.path.join(self.cache_dir, name))
+        with open(os.path.join(self.cache_dir, 'index.json'), 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+
+    def digest(self, name, path, index):
+        stat = os.stat(path)
+        cached = index['files'].get(name)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        index['files'][name] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def compiled(self, files, index):
+        # files with the pycs added (or in place of sourceless modules), compiled once per module content
+        python = [self.compile] if isinstance(self.compile, str) else list(self.compile)
+        tag = subprocess.run(
+            python + ['-c', 'import sys; print(sys.implementation.cache_tag)'], check=True, capture_output=True,
+            text=True
+        ).stdout.strip()
+        directory = os.path.join(self.cache_dir, 'pyc')
+        os.makedirs(directory, exist_ok=True)
+        compiled = dict(files)
+        pending = []
+        used = set()
+        for name, path in files.items():
+            if not name.endswith('.py'):
+                continue
+            key = hashlib.sha256('{} {} {}'.format(tag, name, self.digest(name, path, index)).encode()).hexdigest()
+            cfile = os.path.join(directory, '{}.pyc'.format(key))
+            used.add(os.path.basename(cfile))
+            if not os.path.exists(cfile):
+                pending.append((os.path.abspath(path), os.path.abspath(cfile), name))
+            parent, module = name[:-3].rpartition('/')[::2]
+            if matches(name, self.sourceless):
+                del compiled[name]
+                compiled[name[:-3] + '.pyc'] = cfile
+            else:
+                compiled['{}/__pycache__/{}.{}.pyc'.format(parent, module, tag).lstrip('/')] = cfile
+        if pending:
+            subprocess.run(python + ['-c', COMPILE], input=json.dumps(pending), text=True, check=True)
+        for name in os.listdir(directory):
+            if name not in used:
+                os.remove(os.path.join(directory, name))
+        return dict(sorted(compiled.items()))
+
+    def entry(self, name, path, index):
+        # (data, crc, size, method) of a file, compressed only when its content changed
+        digest = self.digest(name, path, index)
+        blob = os.path.join(self.cache_dir, '{}.z'.format(digest))
+        if digest in index['blobs'] and os.path.exists(blob):
+            self.reused += 1
+            with open(blob, 'rb') as f:
+                return (f.read(),) + tuple(index['blobs'][digest])
+        with open(path, 'rb') as f:
+            data = f.read()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        method = 8
+        if len(compressed) >= len(data):
+            compressed, method = data, 0
+        self.compressed += 1
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(blob, 'wb') as f:
+            f.write(compressed)
+        index['blobs'][digest] = [zlib.crc32(data), len(data), method]
+        return compressed, zlib.crc32(data), len(data), method
+
+    def build(self):
+        index = self.load()
+        local = []
+        central = []
+        offset = 0
+        sources = self.files()
+        files = self.compiled(sources, index) if self.compile else sources
+        for name, path in files.items():
+            data, crc, size, method = self.entry(name, path, index)
+            encoded = name.encode()
+            flags = 0 if encoded.isascii() else 0x800
+            header = struct.pack(
+                '<4s5H3L2H', b'PK\x03\x04', 20, flags, method, DOS_TIME, DOS_DATE, crc, len(data), size, len(encoded), 0
+            )
+            mode = 0o755 if os.access(path, os.X_OK) else 0o644
+            central.append(struct.pack(
+                '<4s6H3L5H2L', b'PK\x01\x02', (3 << 8) | 20, 20, flags, method, DOS_TIME, DOS_DATE, crc, len(data),
+                size, len(encoded), 0, 0, 0, 0, (0o100000 | mode) << 16, offset
+            ) + encoded)
+            local.append(header + encoded + data)
+            offset += len(header) + len(encoded) + len(data)
+        index['files'] = {name: entry for name, entry in index['files'].items() if name in files or name in sources}
+        self.save(index)
+        directory = b''.join(central)
+        end = struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, len(central), len(central), len(directory), offset, 0)
+        return b''.join(local) + directory + end
+
+    def write(self, filename):
+        package = self.build()
+        with open(filename, 'wb') as f:
+            f.write(package)
+        return sha256(package)
+
+
+class Layer(object):
+    # requirements pip installed into .build/layers/<name>/python for the Lambda platform, from the wheels cached in
+    # .build/wheels (downloaded only when missing); the install is kept while requirements and options are the
+    # same, files matching prune are removed and shared objects are optionally stripped
+    def __init__(self, name, requirements=(), python='3.8', platform='manylinux2014_x86_64', prune=PRUNE,
+                 strip=False, root='.build/layers', wheels='.build/wheels'):
+        self.name = name
+        self.requirements = [requirements] if isinstance(requirements, str) else list(requirements)
+        self.python = python
+        self.platform = platform
+        self.prune = tuple(prune)
+        self.strip = strip
+        self.dir = os.path.join(root, name)
+        self.target = os.path.join(self.dir, 'python')
+        self.wheels = wheels
+        self.sizes = {}
+
+    @property
+    def key(self):
+        options = [self.requirements, self.python, self.platform, self.prune, self.strip]
+        return hashlib.sha256(json.dumps(options).encode()).hexdigest()
+
+    def pip(self, command, *args, quiet=False):
+        # pip of the runtime version when there is one, otherwise dependency markers are evaluated for this Python
+        try:
+            python = interpreter(self.python)
+        except RuntimeError:
+            python = sys.executable
+        subprocess.run([
+            python, '-m', 'pip', command, '--disable-pip-version-check', '--quiet', '--only-binary=:all:',
+            '--platform', self.platform, '--python-version', self.python, '--implementation', 'cp'
+        ] + list(args) + self.requirements, check=True, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL if quiet else None)
+
+    def build(self):
+        stamp = os.path.join(self.dir, '.key')
+        try:
+            with open(stamp) as f:
+                built = f.read() == self.key
+        except OSError:
+            built = False
+        if not built:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            os.makedirs(self.wheels, exist_ok=True)
+            try:
+                self.pip('install', '--no-index', '--find-links', self.wheels, '--target', self.target, quiet=True)
+            except subprocess.CalledProcessError:
+                # layers built concurrently share the wheel cache, two downloads of a dependency would race on its file
+                with DOWNLOAD:
+                    self.pip('download', '--dest', self.wheels)
+                self.pip('install', '--no-index', '--find-links', self.wheels, '--target', self.target)
+            self.clean()
+            if self.strip:
+                self.strip_objects()
+            with open(stamp, 'w') as f:
+                f.write(self.key)
+        self.sizes = self.measure()
+        return self
+
+    def clean(self):
+        for root, dirs, names in os.walk(self.target, topdown=True):
+            rel = os.path.relpath(root, self.target).replace(os.sep, '/')
+            for d in list(dirs):
+                if matches(d if rel == '.' else '{}/{}'.format(rel, d), self.prune):
+                    shutil.rmtree(os.path.join(root, d))
+                    dirs.remove(d)
+            for name in names:
+                if matches(name if rel == '.' else '{}/{}'.format(rel, name), self.prune):
+                    os.remove(os.path.join(root, name))
+
+    def strip_objects(self):
+        strip = shutil.which('strip')
+        if strip is None:
+            return
+        for root, dirs, names in os.walk(self.target):
+            # libraries vendored by auditwheel (in <package>.libs) were relinked with patchelf, strip breaks them
+            dirs[:] = [d for d in dirs if not d.endswith('.libs')]
+            for name in names:
+                if name.endswith('.so') or '.so.' in name:
+                    subprocess.run([strip, '--strip-unneeded', os.path.join(root, name)], stderr=subprocess.DEVNULL)
+
+    def measure(self):
+        # bytes per top level package or module
+        sizes = {}
+        for root, dirs, names in os.walk(self.target):
+            rel = os.path.relpath(root, self.target)
+            for name in names:
+                top = name if rel == '.' else rel.split(os.sep)[0]
+                sizes[top] = sizes.get(top, 0) + os.path.getsize(os.path.join(root, name))
+        return dict(sorted(sizes.items(), key=lambda item: -item[1]))
+
+    def package(self, compile=None, sourceless=()):
+        if not os.path.isdir(self.target):
+            raise RuntimeError('Layer {} is not built, see ServerlessApp.create_lambda_layer'.format(self.name))
+        cache_dir = os.path.join('.build', 'pack', 'layer-{}'.format(self.name))
+        return Packager(self.target, exclude=(), cache_dir=cache_dir, compile=compile, sourceless=sourceless).build()
@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+# run in the fresh interpreter: times django.setup and the app registry population when the module sets Django up,
+# then imports the module; the import times after the marker line belong to it
+CHILD = '''
+import json, sys, time
+timings = {}
+try:
+    import django
+except ImportError:
+    django = None
+if django is not None:
+    setup = django.setup
+
+    def timed_setup(*args, **kwargs):
+        from django.apps import apps
+        populate = apps.populate
+
+        def timed_populate(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return populate(*args, **kwargs)
+            finally:
+                timings['populate'] = timings.get('populate', 0) + time.perf_counter() - start
+        apps.populate = timed_populate
+        start = time.perf_counter()
+        try:
+            return setup(*args, **kwargs)
+        finally:
+            timings['setup'] = timings.get('setup', 0) + time.perf_counter() - start
+            del apps.populate
+    django.setup = timed_setup
+sys.stderr.write('import time: profiler\\n')
+start = time.perf_counter()
+__import__(sys.argv[1])
+timings['total'] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def parse(output):
+    # -X importtime lines come after the imports they trigger, indented two spaces per level: a line closes the
+    # pending lines one level deeper as its children. Times are in microseconds
+    output = output.split('import time: profiler\n', 1)[-1]
+    pending = {0: []}
+    for line in output.splitlines():
+        match = LINE.match(line)
+        if not match:
+            continue
+        depth = (len(match.group(3)) - 1) // 2
+        node = {
+            'name': match.group(4), 'self': int(match.group(1)), 'cumulative': int(match.group(2)),
+            'children': pending.pop(depth + 1, [])
+        }
+        pending.setdefault(depth, []).append(node)
+    return pending[0]
+
+
+def profile(module='app', python=sys.executable, path=(), cwd=None, env=None):
+    # imports the module in a fresh interpreter that cannot write bytecode, like on the read-only Lambda filesystem,
+    # and without the user site-packages
+    env = dict(os.environ if env is None else env, PYTHONDONTWRITEBYTECODE='1')
+    if path:
+        env['PYTHONPATH'] = os.pathsep.join(tuple(path) + tuple(filter(None, [env.get('PYTHONPATH')])))
+    result = subprocess.run(
+        [python, '-s', '-X', 'importtime', '-c', CHILD, module], cwd=cwd, env=env, capture_output=True, text=True
+    )
+    if result.returncode:
+        raise RuntimeError('Importing {} failed:\n{}'.format(module, result.stderr[-4000:]))
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return dict(timings, module=module, python=python, imports=parse(result.stderr))
+
+
+def remote(event):
+    # run inside the deployed function, see ServerlessApp.profile_lambda
+    return profile(event['profile'], cwd=os.environ.get('LAMBDA_TASK_ROOT'))
+
+
+def flatten(nodes, totals=None):
+    # {name: [self, cumulative]} over the whole tree
+    totals = {} if totals is None else totals
+    for node in nodes:
+        entry = totals.setdefault(node['name'], [0, 0])
+        entry[0] += node['self']
+        entry[1] += node['cumulative']
+        flatten(node['children'], totals)
+    return totals
+
+
+def render(result, depth=4, threshold=1000, top=15):
+    # ranked tree of the imports taking at least threshold microseconds, then the most expensive by self time
+    lines = ['{} imported in {:.0f} ms'.format(result['module'], result['total'] * 1000)]
+    if 'setup' in result:
+        lines.append('django.setup {:.0f} ms, apps populated in {:.0f} ms'.format(
+            result['setup'] * 1000, result.get('populate', 0) * 1000
+        ))
+    lines.append('{:>10} {:>10}  module'.format('cumul ms', 'self ms'))
+
+    def walk(nodes, level):
+        for node in sorted(nodes, key=lambda node: -node['cumulative']):
+            if node['cumulative'] < threshold:
+                break
+            lines.append('{:>10.1f} {:>10.1f}  {}{}'.format(
+                node['cumulative'] / 1000, node['self'] / 1000, '  ' * level, node['name']
+            ))
+            if level + 1 < depth:
+                walk(node['children'], level + 1)
+    walk(result['imports'], 0)
+    lines.append('{:>10}  slowest by self time'.format('self ms'))
+    for name, (own, cumulative) in sorted(flatten(result['imports']).items(), key=lambda item: -item[1][0])[:top]:
+        lines.append('{:>10.1f}  {}'.format(own / 1000, name))
+    return '\n'.join(lines)
+
+
+def diff(before, after, top=20):
+    # modules ranked by the change of their cumulative time, (name, before, after) in microseconds
+    a = flatten(before['imports'])
+    b = flatten(after['imports'])
+    rows = [(name, a.get(name, [0, 0])[1], b.get(name, [0, 0])[1]) for name in set(a) | set(b)]
+    return sorted(rows, key=lambda row: -abs(row[2] - row[1]))[:top]
+
+
+def render_diff(before, after, top=20):
+    lines = ['total {:.0f} ms -> {:.0f} ms'.format(before['total'] * 1000, after['total'] * 1000)]
+    for key in ('setup', 'populate'):
+        if key in before or key in after:
+            lines.append('{} {:.0f} ms -> {:.0f} ms'.format(
+                key, before.get(key, 0) * 1000, after.get(key, 0) * 1000
+            ))
+    lines.append('{:>10} {:>10} {:>10}  module'.format('before ms', 'after ms', 'delta ms'))
+    for name, a, b in diff(before, after, top):
+        lines.append('{:>10.1f} {:>10.1f} {:>+10.1f}  {}'.format(a / 1000, b / 1000, (b - a) / 1000, name))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold start import profile of a Lambda handler module')
+    parser.add_argument('module', nargs='?', default='app')
+    parser.add_argument('--python', default=sys.executable, help='interpreter of the runtime version')
+    parser.add_argument('--path', action='append', default=[], help='directories added to PYTHONPATH, e.g. layers')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--threshold', type=float, default=1, help='smallest cumulative time shown, in ms')
+    parser.add_argument('--save', help='write the profile to this JSON file')
+    parser.add_argument('--diff', help='compare with a profile saved before')
+    args = parser.parse_args()
+    result = profile(args.module, args.python, args.path)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f)
+    if args.diff:
+        with open(args.diff) as f:
+            print(render_diff(json.load(f), result))
+    else:
+        print(render(result, args.depth, args.threshold * 1000))
@@ -1,30 +1,102 @@
 import datetime
-import os
 import io
+import os
+import tempfile
+import time
 import json
 import zipfile
 import boto3
-import shutil
+import profiler
 from dotenv import load_dotenv
 from botocore.exceptions import ClientError
 from boto3.dynamodb.types import STRING
 from uuid import uuid1
+from orm import Index
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from packager import EXCLUDE, Layer, Packager, interpreter, sha256
 load_dotenv()
 
 
+class Step(object):
+    # a deployment step, called with the results of the steps it requires as keyword arguments
+    def __init__(self, name, func, requires=()):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+
+
+def execute(steps, workers=4, log=print):
+    # runs the steps as a dependency graph, independent ones concurrently, and logs when each one started and how
+    # long it took; after a failure no new step is started and the error is raised once the running ones finish
+    steps = {step.name: step for step in steps}
+    for step in steps.values():
+        for name in step.requires:
+            if name not in steps:
+                raise ValueError('Step {} requires unknown step {}'.format(step.name, name))
+    pending = dict(steps)
+    results = {}
+    timings = {}
+    running = {}
+    error = None
+    start = time.perf_counter()
+
+    def run(step):
+        began = time.perf_counter()
+        try:
+            return step.func(**{name: results[name] for name in step.requires})
+        finally:
+            timings[step.name] = (began - start, time.perf_counter() - began)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            if error is None:
+                for name, step in list(pending.items()):
+                    if all(required in results for required in step.requires):
+                        running[executor.submit(run, step)] = name
+                        del pending[name]
+            if not running:
+                if error is None:
+                    raise ValueError('Steps {} have cyclic requirements'.format(', '.join(sorted(pending))))
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    log('Step {} failed: {!r}'.format(name, e))
+                    error = error or e
+    log('{:<12} {:>10} {:>10}'.format('step', 'start s', 'seconds'))
+    for name, (began, seconds) in sorted(timings.items(), key=lambda item: item[1][0]):
+        log('{:<12} {:>10.1f} {:>10.1f}'.format(name, began, seconds))
+    for name in pending:
+        log('{:<12} {:>10} {:>10}'.format(name, '-', 'skipped'))
+    log('{:<12} {:>10} {:>10.1f}'.format('total', '', time.perf_counter() - start))
+    if error is not None:
+        raise error
+    return results
+
 
 class ServerlessApp():
-    def __init__(self, key, secret, region_name, name, path, debug=True):
+    def __init__(self, key, secret, region_name, name, path, debug=True, include=('*',), exclude=EXCLUDE,
+                 compile=False, sourceless=()):
         self.key = key
         self.secret = secret
         self.region_name = region_name
         self.name = name
+        # a file or directory, or a list of them, packed at the root of the bundle
         self.path = path
+        self.include = include
+        self.exclude = exclude
+        # ship unchecked-hash pycs compiled for the runtime, and only the pycs of the modules matching sourceless
+        self.compile = compile
+        self.sourceless = sourceless
         self.debug = debug
         self.iam = self.get_client('iam')
         self.logs = self.get_client('logs')
         self.lam = self.get_client('lambda')
         self.apigateway = self.get_client('apigateway')
+        self.s3 = self.get_client('s3')
         self.dynamodb = self.get_resource('dynamodb')
         self.runtime = 'python3.8'
 
@@ -32,11 +104,28 @@ class ServerlessApp():
         if self.debug:
             print(data)
 
-    def build(self):
-        self.create_role()
-        self.create_lambda()
-        self.create_api()
-        self.deploy_api()
+    def build(self, models=(), layers=(), bucket=False, table=False, workers=4):
+        # role, bucket, table and layers are independent; the function waits for the role and layers, the API and
+        # permissions for the function. Every step waits until what it created is usable, see execute
+        steps = [Step('role', self.create_role)]
+        if bucket:
+            steps.append(Step('bucket', self.create_bucket))
+        if table or models:
+            steps.append(Step('table', lambda: self.create_table(*models)))
+        if models:
+            steps.append(Step('indexes', lambda table: self.sync_indexes(*models), requires=['table']))
+        if layers:
+            steps.append(Step('layers', lambda: self.upload_lamba_layer(*layers)))
+        steps.append(Step(
+            'function', lambda role, layers=None: self.create_lambda(list((layers or {}).values())),
+            requires=['role'] + (['layers'] if layers else [])
+        ))
+        steps.append(Step('api', lambda function: self.create_api(), requires=['function']))
+        steps.append(Step(
+            'permissions', lambda **done: self.create_permissions(bucket),
+            requires=['role', 'function'] + (['bucket'] if bucket else [])
+        ))
+        return execute(steps, workers, self.log)
 
     def get_client(self, name):
         return boto3.client(name, aws_access_key_id=self.key, aws_secret_access_key=self.secret, region_name=self.region_name)
@@ -93,7 +182,9 @@ class ServerlessApp():
                     AssumeRolePolicyDocument=json.dumps(doc)
                 )
                 self.log(role)
+                self.iam.get_waiter('role_exists').wait(RoleName=self.name)
                 return role
+            raise e
 
     def delete_role(self):
         for policy in self.iam.list_attached_role_policies(RoleName=self.name)['AttachedPolicies']:
@@ -109,16 +200,16 @@ class ServerlessApp():
         return '{}-bckt'.format(self.name.lower())
 
     def create_bucket(self):
-        s3 = self.get_client('s3')
         self.log('Creating bucket...')
         try:
-            response = s3.create_bucket(
+            response = self.s3.create_bucket(
                 Bucket=self.get_bucket_name()
             )
             self.log(response)
+            self.s3.get_waiter('bucket_exists').wait(Bucket=self.get_bucket_name())
             return response
         except ClientError as e:
-            if e.response['Error']['Code'] == 'EntityAlreadyExists':
+            if e.response['Error']['Code'] in ('EntityAlreadyExists', 'BucketAlreadyOwnedByYou'):
                 self.log('Bucket already exists!')
             else:
                 raise e
@@ -152,8 +243,7 @@ class ServerlessApp():
                 raise e
 
     def upload_file(self, filename):
-        s3 = self.get_client('s3')
-        response = s3.upload_file(filename, self.get_bucket_name(), filename)
+        response = self.s3.upload_file(filename, self.get_bucket_name(), filename)
         print(response)
 
     def empty_bucket(self):
@@ -163,41 +253,75 @@ class ServerlessApp():
         self.log(response)
 
     def delete_bucket(self):
-        s3 = self.get_client('s3')
-        response = s3.delete_bucket(Bucket=self.get_bucket_name())
+        response = self.s3.delete_bucket(Bucket=self.get_bucket_name())
         self.log(response)
 
     # LAMBDA
     def get_lambda_name(self):
         return self.name
 
-    def pack(self):
-        package = io.BytesIO()
-        z = zipfile.ZipFile(package, 'w')
-        z.write(self.path, self.path)
-        z.close()
-        return package.getvalue()
+    def get_interpreter(self, compile=None):
+        compile = self.compile if compile is None else compile
+        if not compile:
+            return None
+        return compile if isinstance(compile, str) else interpreter(self.runtime[len('python'):])
+
+    def pack(self, compile=None):
+        paths = (self.path,) if isinstance(self.path, str) else self.path
+        packager = Packager(
+            *paths, include=self.include, exclude=self.exclude, cache_dir=os.path.join('.build', 'pack', self.name),
+            compile=self.get_interpreter(compile), sourceless=self.sourceless
+        )
+        package = packager.build()
+        self.log('Packed {} files ({} compressed, {} reused), {} bytes'.format(
+            packager.compressed + packager.reused, packager.compressed, packager.reused, len(package)
+        ))
+        return package
 
-    def create_lambda(self):
+    def create_lambda(self, layers=(), delay=2, max_attempts=30):
         self.log('Creating lambda...')
         role = self.iam.get_role(RoleName=self.name)
         try:
             function = self.lam.get_function(FunctionName=self.get_lambda_name())
             self.log('Lambda already exists!')
+            current = [layer['Arn'] for layer in function['Configuration'].get('Layers', [])]
+            if layers and list(layers) != current:
+                # the function keeps its layers unless new versions are given, e.g. by build() after uploading them
+                self.log('Updating lambda layers...')
+                self.lam.update_function_configuration(FunctionName=self.get_lambda_name(), Layers=list(layers))
+                self.lam.get_waiter('function_updated_v2').wait(FunctionName=self.get_lambda_name())
+                function = self.lam.get_function(FunctionName=self.get_lambda_name())
             return function
         except ClientError as e:
-            if e.response['Error']['Code'] == 'ResourceNotFoundException':
-                function = self.lam.create_function(
-                    FunctionName=self.get_lambda_name(),
-                    Runtime=self.runtime,
-                    Role=role['Role']['Arn'],
-                    Handler='app.handler',
-                    Code={'ZipFile': self.pack()}
-                )
-                self.log(function)
-                return function
-            else:
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
                 raise e
+        params = dict(
+            FunctionName=self.get_lambda_name(),
+            Runtime=self.runtime,
+            Role=role['Role']['Arn'],
+            Handler='app.handler',
+            Code={'ZipFile': self.pack()}
+        )
+        if layers:
+            params['Layers'] = list(layers)
+        for attempt in range(max_attempts):
+            try:
+                function = self.lam.create_function(**params)
+                break
+            except ClientError as e:
+                # a new role can't be assumed by Lambda for a few seconds and there is no waiter for that, other
+                # invalid parameters (package size, layer ARNs) are not retried
+                propagating = (
+                    e.response['Error']['Code'] == 'InvalidParameterValueException'
+                    and 'cannot be assumed' in e.response['Error'].get('Message', '')
+                )
+                if not propagating or attempt == max_attempts - 1:
+                    raise e
+                self.log('Waiting for the role to be assumable...')
+                time.sleep(delay)
+        self.log(function)
+        self.lam.get_waiter('function_active_v2').wait(FunctionName=self.get_lambda_name())
+        return function
 
     def create_lambda_policy(self):
         response = self.lam.get_function(FunctionName=self.get_lambda_name())
@@ -228,35 +352,103 @@ class ServerlessApp():
             else:
                 raise e
 
-    def create_lambda_layer(self, **modules):
-        for name, module in modules.items():
-            layer_dir = 'layer/{}/python'.format(name)
-            os.makedirs(layer_dir, exist_ok=True)
-            os.system('pip install --platform manylinux1_x86_64 --only-binary=:all: {} -t {}'.format(module, layer_dir))
+    def create_permissions(self, bucket=False):
+        self.create_lambda_policy()
+        if bucket:
+            self.create_bucket_policy()
+
+    def create_lambda_layer(self, strip=False, workers=4, **modules):
+        # layers are installed concurrently, see packager.Layer
+        layers = [
+            Layer(name, module, python=self.runtime[len('python'):], strip=strip) for name, module in modules.items()
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for layer in executor.map(Layer.build, layers):
+                self.log('Layer {}: {:.1f} MB'.format(layer.name, sum(layer.sizes.values()) / 2 ** 20))
+                for package, size in layer.sizes.items():
+                    self.log('  {:<40} {:>10.1f} KB'.format(package, size / 2 ** 10))
+        return layers
 
     def upload_lamba_layer(self, *names):
+        # the content hash is kept in the description, an unchanged layer is not published again
+        arns = {}
         for name in names:
-            file_name = '{}.zip'.format(name)
-            shutil.make_archive(name, 'zip', 'layer/{}'.format(name))
+            package = Layer(name).package(self.get_interpreter(), self.sourceless)
+            digest = sha256(package)
+            versions = self.lam.list_layer_versions(LayerName=name)['LayerVersions']
+            if versions and digest in versions[0].get('Description', ''):
+                self.log('Layer {} is unchanged!'.format(name))
+                arns[name] = versions[0]['LayerVersionArn']
+                continue
             self.log('Publishing layer {}...'.format(name))
             response = self.lam.publish_layer_version(
                 LayerName=name,
-                Description='Layer for {}'.format(name),
-                Content={'ZipFile': open(file_name, 'r+b').read()},
+                Description='Layer for {} sha256:{}'.format(name, digest),
+                Content={'ZipFile': package},
                 CompatibleRuntimes=[self.runtime],
                 LicenseInfo='N/A'
             )
             self.log(response)
-            return
-            self.log('Updating lambda layers...')
-            response = self.lam.update_function_configuration(FunctionName=self.name, Layers=[response['LayerVersionArn']])
-            self.log(response)
-
-    def update_lambda_code(self):
+            arns[name] = response['LayerVersionArn']
+        return arns
+
+    def extract(self, root, layers, compile):
+        # the bundle and the layers unpacked like in /var/task and /opt, returns the python path and their total size
+        python = interpreter(self.runtime[len('python'):])
+        packages = [('task', self.pack(compile))] + [
+            (name, Layer(name).package(python if compile else None, self.sourceless)) for name in layers
+        ]
+        for name, package in packages:
+            with zipfile.ZipFile(io.BytesIO(package)) as z:
+                z.extractall(os.path.join(root, name))
+        path = [os.path.join(root, 'task')] + [os.path.join(root, name, 'python') for name in layers]
+        return path, sum(len(package) for name, package in packages)
+
+    def profile_imports(self, module='app', layers=(), compile=None):
+        # cold start import profile of the bundle and layers, unpacked and imported by the runtime interpreter
+        python = interpreter(self.runtime[len('python'):])
+        with tempfile.TemporaryDirectory() as root:
+            path, size = self.extract(root, layers, self.compile if compile is None else compile)
+            result = profiler.profile(module, python, path, cwd=path[0])
+        self.log(profiler.render(result))
+        return result
+
+    def profile_lambda(self, module='app'):
+        # the same profile taken inside the deployed function, its bundle needs profiler.py (see the handler in app.py)
+        result = self.invoke_lambda({'profile': module})
+        if 'errorMessage' in result:
+            raise RuntimeError(result['errorMessage'])
+        self.log(profiler.render(result))
+        return result
+
+    def bytecode_report(self, module='app', layers=(), repeat=3):
+        # bundle size and best import time of the module (with the built layers) without and with precompiled bytecode
+        python = interpreter(self.runtime[len('python'):])
+        report = {}
+        for compile in (False, True):
+            with tempfile.TemporaryDirectory() as root:
+                path, size = self.extract(root, layers, compile)
+                seconds = min(profiler.profile(module, python, path, cwd=path[0])['total'] for _ in range(repeat))
+                report[compile] = dict(size=size, seconds=seconds)
+        for compile, result in report.items():
+            self.log('{:<10} {:>8.1f} MB {:>8.0f} ms'.format(
+                'compiled' if compile else 'source', result['size'] / 2 ** 20, result['seconds'] * 1000
+            ))
+        return report
+
+    def update_lambda_code(self, force=False):
+        package = self.pack()
+        if not force:
+            deployed = self.lam.get_function_configuration(FunctionName=self.name)['CodeSha256']
+            if deployed == sha256(package):
+                self.log('Lambda code is unchanged!')
+                return None
         response = self.lam.update_function_code(
-            FunctionName=self.name, ZipFile=self.pack()
+            FunctionName=self.name, ZipFile=package
         )
         self.log(response)
+        self.lam.get_waiter('function_updated_v2').wait(FunctionName=self.name)
+        return response
 
     def invoke_lambda(self, payload):
         response = self.lam.invoke(
@@ -292,8 +484,7 @@ class ServerlessApp():
         self.log(response)
 
     # DYNAMODB
-    def create_table(self):
-        breakpoint()
+    def create_table(self, *models):
         params = {
             'TableName': self.name,
             'KeySchema': [
@@ -309,6 +500,19 @@ class ServerlessApp():
                 'WriteCapacityUnits': 1
             }
         }
+        # local indexes can only be created with the table, global ones are created here as well
+        indexes = {}
+        for model in models:
+            for index in model.indexes:
+                if index.name not in indexes:
+                    indexes[index.name] = index
+                    for attr in index.attributes(model):
+                        if attr not in params['AttributeDefinitions']:
+                            params['AttributeDefinitions'].append(attr)
+        for key, local in (('LocalSecondaryIndexes', True), ('GlobalSecondaryIndexes', False)):
+            definitions = [index.definition() for index in indexes.values() if index.local == local]
+            if definitions:
+                params[key] = definitions
         self.log(params)
         try:
             table = self.dynamodb.create_table(**params)
@@ -320,35 +524,52 @@ class ServerlessApp():
                 raise e
         return table
 
-    def create_index(self, attr_name, attr_type='S'):
-        attrs = [
-            {'AttributeName': 'model', 'AttributeType': 'S'},
-            {"AttributeName": attr_name, "AttributeType": attr_type}
-        ]
-        indexes = [
-            {"Create":
-                {
-                    "IndexName": attr_name,
-                    "KeySchema": [
-                        {
-                            "AttributeName": "model",
-                            "KeyType": "HASH"
-                        },
-                        {
-                            "AttributeName": "sexo",
-                            "KeyType": "RANGE"
-                        }
-                    ],
-                    'Projection': {'ProjectionType': "KEYS_ONLY"},
-                    'ProvisionedThroughput': {'ReadCapacityUnits': 2, 'WriteCapacityUnits': 2}
-                }
-            }
-        ]
+    def create_index(self, attr_name, attr_type='S', projection='KEYS_ONLY', include=(), read=2, write=2):
+        index = Index(
+            attr_name, range=attr_name, projection=projection, include=include,
+            types={attr_name: attr_type}, read=read, write=write
+        )
+        return self.add_index(index)
+
+    def add_index(self, index, model=None):
         table = self.dynamodb.Table(self.name)
-        response = table.update(AttributeDefinitions=attrs, GlobalSecondaryIndexUpdates=indexes)
-        print(response)
+        billing = (table.billing_mode_summary or {}).get('BillingMode', 'PROVISIONED')
+        self.log('Creating index {}...'.format(index.name))
+        response = table.meta.client.update_table(
+            TableName=self.name,
+            AttributeDefinitions=index.attributes(model),
+            GlobalSecondaryIndexUpdates=[{'Create': index.definition(billing == 'PROVISIONED')}]
+        )
+        self.log(response)
+        self.wait_index(index.name)
         return response
 
+    def sync_indexes(self, *models):
+        table = self.dynamodb.Table(self.name)
+        existing = {index['IndexName'] for index in table.global_secondary_indexes or ()}
+        existing.update(index['IndexName'] for index in table.local_secondary_indexes or ())
+        for model in models:
+            for index in model.indexes:
+                if index.name in existing:
+                    continue
+                existing.add(index.name)
+                if index.local:
+                    self.log('Local index {} can only be created with the table!'.format(index.name))
+                else:
+                    # DynamoDB only accepts one new global index per update
+                    self.add_index(index, model)
+
+    def wait_index(self, name, delay=10, max_attempts=90):
+        client = self.dynamodb.meta.client
+        for attempt in range(max_attempts):
+            table = client.describe_table(TableName=self.name)['Table']
+            for index in table.get('GlobalSecondaryIndexes', ()):
+                if index['IndexName'] == name and index['IndexStatus'] == 'ACTIVE' and table['TableStatus'] == 'ACTIVE':
+                    self.log('Index {} is active!'.format(name))
+                    return
+            time.sleep(delay)
+        raise TimeoutError('Index {} is not active after {} seconds'.format(name, delay * max_attempts))
+
     def delete_table(self):
         try:
             table = self.dynamodb.Table(self.name)
@@ -358,7 +579,9 @@ class ServerlessApp():
                 raise e
 
     def create_api(self):
-        lam = self.get_client('lambda')
+        if self.get_api(self.name):
+            self.log('API already exists!')
+            return self.get_api_url()
         api = self.apigateway.create_rest_api(name=self.name)
         root = self.apigateway.get_resources(restApiId=api['id'])['items'][0]
         resource = self.apigateway.create_resource(restApiId=api['id'], parentId=root['id'], pathPart='{proxy+}')
@@ -371,7 +594,7 @@ class ServerlessApp():
             restApiId=api['id'], resourceId=resource['id'], httpMethod='ANY', statusCode='200'
         )
         self.log(put_method_response)
-        function = lam.get_function(FunctionName=self.name)
+        function = self.lam.get_function(FunctionName=self.name)
         uri = 'arn:aws:apigateway:{}:lambda:path/2015-03-31/functions/{}/invocations'.format(
             self.apigateway.meta.region_name, function['Configuration']['FunctionArn']
         )
@@ -425,7 +648,12 @@ class ServerlessApp():
 
 if __name__ == '__main__':
     app = ServerlessApp(os.environ['KEY'], os.environ['SECRET'], os.environ['REGION'], 'HelloWorld', 'app.py', debug=True)
+    # app = ServerlessApp(
+    #     os.environ['KEY'], os.environ['SECRET'], os.environ['REGION'], 'HelloWorld', ['app.py', 'python/helloworld'],
+    #     exclude=EXCLUDE + ('*.md',)
+    # )
 
+    # app.build(layers=('django', 'postgres'), bucket=True)
     # app.create_role()
     # app.delete_role()
 
@@ -437,11 +665,12 @@ if __name__ == '__main__':
 
     # app.create_lambda()
     # app.create_lambda_policy()
-    # app.create_lambda_layer(django=('Django==3.2', 'aws-wsgi'))
-    # app.create_lambda_layer(pillow=('Pillow==8.0'))
-    # app.create_lambda_layer(postgres=('psycopg2-binary==2.7.5'))
+    # app.create_lambda_layer(django=('Django==3.2', 'aws-wsgi'), pillow='Pillow==8.0', postgres='psycopg2-binary==2.8.6')
     # app.upload_lamba_layer('postgres')
     # app.update_lambda_code()
+    # app.bytecode_report('app', layers=('django',))
+    # local = app.profile_imports('app', layers=('django', 'postgres'))  # profile_lambda needs profiler.py in the path
+    # print(profiler.render_diff(local, app.profile_lambda('app')))
     app.invoke_lambda(dict(a=1, b=2))
     # app.delete_lambda_layer()
     # app.delete_lambda()
@@ -452,6 +681,8 @@ if __name__ == '__main__':
 
     # app.create_table()
     # app.create_index('sexo')
+    # from test import Pessoa
+    # app.sync_indexes(Pessoa)
     # app.delete_table()
 
     # app.get_cost()
\ No newline at end of file
@@ -1,11 +1,77 @@
+import datetime
+import time
+
+from botocore.stub import Stubber
+
 from orm import Model
+from serverless import ServerlessApp, Step, execute
 
 
 class Pessoa(Model):
-    pass
+    indexes = ('sexo',)
+
+
+class Contato(Model):
+    fields = {'email': str, 'telefone': str, 'prioridade': int}
+
+
+def check_steps():
+    # the deployment graph with fake steps: requirements run first and pass their results, nothing starts after a
+    # failure, and cyclic requirements are refused
+    started = []
+
+    def step(name, seconds=0, fail=False):
+        def run(**results):
+            started.append(name)
+            time.sleep(seconds)
+            if fail:
+                raise RuntimeError(name)
+            return name + ''.join(results[required] for required in sorted(results))
+        return run
+    results = execute([
+        Step('c', step('c'), ['a', 'b']), Step('a', step('a', 0.2)), Step('b', step('b'))
+    ], log=lambda line: None)
+    assert started[-1] == 'c' and results == {'a': 'a', 'b': 'b', 'c': 'cab'}, (started, results)
+    started.clear()
+    try:
+        execute([
+            Step('a', step('a', fail=True)), Step('b', step('b', 0.2)), Step('c', step('c'), ['a'])
+        ], log=lambda line: None)
+        raise AssertionError('the failure was not raised')
+    except RuntimeError:
+        assert sorted(started) == ['a', 'b'], started
+    try:
+        execute([Step('a', step('a'), ['b']), Step('b', step('b'), ['a'])], log=lambda line: None)
+        raise AssertionError('the cycle was not detected')
+    except ValueError:
+        pass
+
+
+def check_lambda_layers():
+    # create_lambda on an existing function replaces its layers and waits for the update (stubbed clients)
+    app = ServerlessApp('key', 'secret', 'us-east-1', 'Check', 'app.py', debug=False)
+    role = {'Role': {
+        'Path': '/', 'RoleName': 'Check', 'RoleId': 'AROAEXAMPLEEXAMPLE01',
+        'Arn': 'arn:aws:iam::123456789012:role/Check', 'CreateDate': datetime.datetime(2020, 1, 1)
+    }}
+    old, new = ('arn:aws:lambda:us-east-1:123456789012:layer:django:{}'.format(version) for version in (1, 2))
+    with Stubber(app.iam) as iam, Stubber(app.lam) as lam:
+        iam.add_response('get_role', role, {'RoleName': 'Check'})
+        lam.add_response('get_function', {'Configuration': {'Layers': [{'Arn': old}]}}, {'FunctionName': 'Check'})
+        lam.add_response('update_function_configuration', {}, {'FunctionName': 'Check', 'Layers': [new]})
+        updated = {'Configuration': {'LastUpdateStatus': 'Successful'}}
+        lam.add_response('get_function', updated, {'FunctionName': 'Check'})
+        lam.add_response('get_function', {'Configuration': {'Layers': [{'Arn': new}]}}, {'FunctionName': 'Check'})
+        function = app.create_lambda([new])
+        lam.assert_no_pending_responses()
+    assert function['Configuration']['Layers'] == [{'Arn': new}], function
 
 
 if __name__ == '__main__':
+    # CHECKING THE DEPLOYMENT STEPS (fake steps and stubbed clients, nothing is created on AWS)
+    # check_steps()
+    # check_lambda_layers()
+
     # COUNTING OBJECTS
     # print(Pessoa.objects.count())
 
@@ -72,7 +138,68 @@ if __name__ == '__main__':
     # print(qs4.values_list('nome', flat=True))
 
     pks = ['9825fa7e2ae611ed97953c15c2da2c92', '9837de882ae611ed97953c15c2da2c92']
-    # Pessoa.objects.fetch(pks)
-    Pessoa.objects.filter2()
+    # print(Pessoa.objects.fetch(pks))
+    # print(Pessoa.objects.fetch(pks, 'nome', 'contato__email'))
+    # CACHING OBJECTS
+    # from orm import cache
+    # cache.configure(max_items=1000, ttl=60)
+    # obj = Pessoa.objects.get(pk='f51d7a4c2ac611ed8f6f3c15c2da2c92')
+    # obj = Pessoa.objects.get(pk='f51d7a4c2ac611ed8f6f3c15c2da2c92')
+    # print(cache.stats())
+
+    # ADDING OBJECTS IN BULK
+    # objs = Pessoa.objects.bulk_create(dict(nome='Pessoa {}'.format(i), idade=i) for i in range(1000))
+    # for obj in objs:
+    #     obj['idade'] += 1
+    # Pessoa.objects.bulk_update(objs, ['idade'])
+
+    # SCANNING IN PARALLEL
+    # for obj in Pessoa.objects.stream(100).parallel(4):
+    #     print(obj)
+
+    # USING THE ASYNC API
+    # import asyncio
+    # async def main():
+    #     async for obj in Pessoa.objects.filter(sexo='M'):
+    #         print(obj)
+    #     print(await Pessoa.objects.acount())
+    #     print(await Pessoa.objects.afetch(pks))
+    # asyncio.run(main())
+
+    # MEASURING CONSUMED CAPACITY
+    # from orm import metrics
+    # metrics.configure(slow=0.5, expensive=10)
+    # print(Pessoa.objects.filter(sexo='M').count())
+    # metrics.emit(emf=True)
+
+    # QUERYING AN INDEX
+    # qs = Pessoa.objects.filter(sexo='M').exclude(idade__lte=20)
+    # print(qs.plan())
+    print(Pessoa.objects.filter(sexo='M').plan())
     # print(Pessoa.objects.all())
+
+    # MAINTAINED COUNTERS (declare counter = 'sexo' on the model, or counter = True for the total only)
+    # print(Pessoa.objects.count(), Pessoa.objects.count_by())
+    # Pessoa.objects.rebuild_counter(segments=8)
+
+    # PAGINATING WITH CURSORS (signed with CURSOR_SECRET)
+    # page = Pessoa.objects.filter(sexo='M').page(20)
+    # next_page = Pessoa.objects.filter(sexo='M').page(20, page.cursor)
+
+    # PREFETCHING REFERENCED OBJECTS (declare fields = {'contato': Contato} or {'contato': Reference('Contato')})
+    # for pessoa in Pessoa.objects.prefetch_related('contato'):
+    #     print(pessoa['nome'], pessoa['contato']['email'])
+
+    # AGGREGATING
+    # from orm import Avg, Count, Max, Sum
+    # print(Pessoa.objects.parallel(4).aggregate(Sum('idade'), Avg('idade'), Max('idade'), Count()))
+    # print(list(Pessoa.objects.values('sexo').annotate(Count(), media=Avg('idade'))))
+
+    # RUNNING OFFLINE AGAINST THE IN-MEMORY BACKEND
+    # from memory import Memory
+    # from orm import connection
+    # backend = Memory(latency=0.005, throttle=0.01)
+    # backend.create_table(Pessoa.objects.table_name, Pessoa)
+    # connection.use(backend)
+    # Pessoa.objects.create(nome='Maria', idade=30, sexo='F')
     pass
\ No newline at end of file